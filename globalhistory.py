@@ -14,32 +14,164 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-from datetime import datetime
+import logging
+import time
+
+from gi.repository import GObject
 
 import places
+from urltrie import UrlTrie
 
 _global_history = None
 
+# Milliseconds to wait before writing queued visits and titles, so
+# that the updates of a page load are committed together.
+_FLUSH_DELAY = 2000
+
+# Milliseconds between rollups of the visits log into the places, and
+# visits rolled up per callback.
+_ROLLUP_DELAY = 10000
+_ROLLUP_BATCH = 500
+
+# Expired places and visits deleted per idle callback, small enough to not be
+# noticed by the user.
+_PRUNE_BATCH = 50
+
+# Seconds of database maintenance per idle callback, and when the
+# activity is saved before closing.
+_MAINTENANCE_BUDGET = 0.1
+_SAVE_MAINTENANCE_BUDGET = 1.0
+
+# Places added to the trigram index per idle callback.
+_TRIGRAM_BATCH = 200
+
+# Places loaded in the URL completion trie.
+_TRIE_PLACES = 1000
+
 
 class GlobalHistory(object):
-    def __init__(self):
-        self._store = places.get_store()
+    def __init__(self, store=None):
+        if store is None:
+            store = places.get_store()
+        self._store = store
+        self._flush_sid = None
+        self._rollup_sid = None
+        self._typed_uri = None
+
+        # Expired places are pruned in the background, once the
+        # activity is done starting up, then the database is
+        # maintained.
+        self._pruned = 0
+        self._prune_time = 0
+        GObject.idle_add(self.__prune_cb)
+        GObject.idle_add(self.__index_trigrams_cb)
+
+        # The completion trie is loaded in the background too, it is
+        # updated on every visit from then on.
+        self._url_trie = None
+        self._trie_version = None
+        GObject.idle_add(self.__load_trie_cb)
 
     def add_page(self, uri):
-        place = self._store.lookup_place(uri)
-        if place:
-            place.visits += 1
-            place.last_visit = datetime.now()
-            self._store.update_place(place)
-        else:
-            place = places.Place(uri)
-            self._store.add_place(place)
+        typed = self._typed_uri is not None and \
+            places.canonical_uri(uri) == self._typed_uri
+        if typed:
+            self._typed_uri = None
+        self._store.add_visit(uri, typed)
+        if self._url_trie is not None:
+            self._url_trie.add_visit(uri, typed)
+        self._schedule_flush()
+
+    def set_typed_uri(self, uri):
+        """Tell that the user typed uri, so that visiting it counts
+        more in its frecency."""
+        self._typed_uri = places.canonical_uri(uri)
+
+    def complete(self, text):
+        """Return the text to append to text to complete it to the
+        most likely host or path, or None."""
+        if self._url_trie is None:
+            return None
+
+        # No query on every keystroke, the version is checked by the
+        # callbacks writing the history.
+        version = self._store.data_version
+        if version != self._trie_version:
+            # Another Browse instance changed the history, the trie is
+            # reloaded in the background and used as is until then.
+            self._trie_version = version
+            GObject.idle_add(self.__load_trie_cb)
+        return self._url_trie.complete(text)
 
     def set_page_title(self, uri, title):
-        place = self._store.lookup_place(uri)
-        if place:
-            place.title = title
-            self._store.update_place(place)
+        self._store.set_title(uri, title)
+        self._schedule_flush()
+
+    def flush(self):
+        """Write the queued history updates now."""
+        if self._flush_sid is not None:
+            GObject.source_remove(self._flush_sid)
+            self._flush_sid = None
+        self._store.flush()
+
+    def maintain(self):
+        """Run the database maintenance that is due, for a bit longer
+        than in idle time, as when the activity closes."""
+        self.flush()
+        self._store.maintain(_SAVE_MAINTENANCE_BUDGET, idle=False)
+
+    def _schedule_flush(self):
+        if self._flush_sid is None:
+            self._flush_sid = GObject.timeout_add(_FLUSH_DELAY,
+                                                  self.__flush_cb)
+
+    def __flush_cb(self):
+        self._flush_sid = None
+        self._store.flush()
+        self._store.get_data_version()
+        if self._rollup_sid is None:
+            self._rollup_sid = GObject.timeout_add(_ROLLUP_DELAY,
+                                                   self.__rollup_cb)
+        return False
+
+    def __rollup_cb(self):
+        self._store.get_data_version()
+        if self._store.rollup(_ROLLUP_BATCH) == _ROLLUP_BATCH:
+            return True
+        self._rollup_sid = None
+        return False
+
+    def __prune_cb(self):
+        start = time.time()
+        count = self._store.prune(_PRUNE_BATCH)
+        self._pruned += count
+        self._prune_time += time.time() - start
+
+        if count < _PRUNE_BATCH:
+            logging.debug('Pruned %d expired places from history in %.3fs',
+                          self._pruned, self._prune_time)
+            GObject.idle_add(self.__maintain_cb)
+            return False
+        return True
+
+    def __maintain_cb(self):
+        self._store.get_data_version()
+        return self._store.maintain(_MAINTENANCE_BUDGET)
+
+    def __index_trigrams_cb(self):
+        # Only places existing before the trigram index was added
+        # are waiting to be indexed.
+        return self._store.index_trigrams(_TRIGRAM_BATCH) == _TRIGRAM_BATCH
+
+    def __load_trie_cb(self):
+        start = time.time()
+        self._trie_version = self._store.get_data_version()
+        url_trie = UrlTrie()
+        url_trie.load(self._store, _TRIE_PLACES)
+        self._url_trie = url_trie
+        logging.debug('Loaded %d URL completions in %.3fs',
+                      len(url_trie), time.time() - start)
+        return False
 
 
 def get_global_history():
@@ -38,35 +38,50 @@ class LinkButton(TrayButton, GObject.GObject):
                         None, ([str])),
         }
 
-    def __init__(self, buf, color, title, owner, hash):
+    def __init__(self, load_thumbnail, color, title, owner, hash):
         TrayButton.__init__(self)
 
         # Color read from the Journal may be Unicode, but Rsvg needs
         # it as single byte string:
         if isinstance(color, unicode):
             color = str(color)
-        self.set_image(buf, color.split(',')[1], color.split(',')[0])
+        self._color = color
+        # Called for the PNG thumbnail, or None, when the button is
+        # first shown.
+        self._load_thumbnail = load_thumbnail
+        self.connect('map', self.__map_cb)
 
         self.hash = hash
         info = title + '\n' + owner
         self.setup_rollover_options(info)
 
+    def __map_cb(self, widget):
+        if self._load_thumbnail is None:
+            return
+        buf = self._load_thumbnail()
+        self._load_thumbnail = None
+        self.set_image(buf, self._color.split(',')[1],
+                       self._color.split(',')[0])
+
     def set_image(self, buf, fill='#0000ff', stroke='#4d4c4f'):
         img = Gtk.Image()
-        str_buf = StringIO.StringIO(buf)
-        thumb_surface = cairo.ImageSurface.create_from_png(str_buf)
-
         xo_buddy = os.path.join(os.path.dirname(__file__), "icons/link.svg")
 
         bg_surface = self._read_link_background(xo_buddy, fill, stroke)
 
-        cairo_context = cairo.Context(bg_surface)
-        dest_x = style.zoom(10)
-        dest_y = style.zoom(20)
-        cairo_context.set_source_surface(thumb_surface, dest_x, dest_y)
-        thumb_width, thumb_height = style.zoom(100), style.zoom(80)
-        cairo_context.rectangle(dest_x, dest_y, thumb_width, thumb_height)
-        cairo_context.fill()
+        # The thumbnail may be missing, like for Journal entries from
+        # other computers.
+        if buf is not None:
+            str_buf = StringIO.StringIO(buf)
+            thumb_surface = cairo.ImageSurface.create_from_png(str_buf)
+            cairo_context = cairo.Context(bg_surface)
+            dest_x = style.zoom(10)
+            dest_y = style.zoom(20)
+            cairo_context.set_source_surface(thumb_surface, dest_x, dest_y)
+            thumb_width, thumb_height = style.zoom(100), style.zoom(80)
+            cairo_context.rectangle(dest_x, dest_y, thumb_width,
+                                    thumb_height)
+            cairo_context.fill()
 
         bg_width, bg_height = style.zoom(120), style.zoom(110)
         pixbuf_bg = Gdk.pixbuf_get_from_surface(bg_surface, 0, 0,
@@ -77,13 +77,18 @@ class Messenger(ExportedGObject):
 
         self.entered = True
 
+    def _get_thumbnail(self, link):
+        return base64.b64encode(self.model.get_thumbnail(link) or '')
+
     def reply_sync(self, a_ids, sender):
         a_ids.pop()
+        a_ids = set(a_ids)
         for link in self.model.data['shared_links']:
             if link['hash'] not in a_ids:
                 self.tube.get_object(sender, PATH).send_link(
                     link['hash'], link['url'], link['title'], link['color'],
-                    link['owner'], link['thumb'], link['timestamp'])
+                    link['owner'], self._get_thumbnail(link),
+                    link['timestamp'])
 
     def error_sync(self, e, when):
         _logger.error('Error %s: %s', when, e)
@@ -93,12 +98,14 @@ class Messenger(ExportedGObject):
     def sync_with_members(self, b_ids, sender=None):
         '''Sync with members '''
         b_ids.pop()
+        b_ids = set(b_ids)
         # links the caller wants from me
         for link in self.model.data['shared_links']:
             if link['hash'] not in b_ids:
                 self.tube.get_object(sender, PATH).send_link(
                     link['hash'], link['url'], link['title'], link['color'],
-                    link['owner'], link['thumb'], link['timestamp'])
+                    link['owner'], self._get_thumbnail(link),
+                    link['timestamp'])
         a_ids = self.model.get_links_ids()
         a_ids.append('')
         # links I want from the caller
@@ -108,8 +115,7 @@ class Messenger(ExportedGObject):
                          out_signature='')
     def send_link(self, identifier, url, title, color, owner, buf, timestamp):
         '''Send link'''
-        a_ids = self.model.get_links_ids()
-        if identifier not in a_ids:
+        if not self.model.knows_link(identifier):
             thumb = base64.b64decode(buf)
             self.model.add_link(url, title, thumb, owner, color, timestamp)
 
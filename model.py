@@ -16,57 +16,411 @@
 #    Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 #
 
+import bisect
 import json
-import sha
+import time
+from hashlib import sha1
 from gi.repository import GObject
 import base64
 
+import sessionfile
+
+
+# Changes appended to the snapshot of the data by serialize() before
+# a new snapshot is written.  One is also written once the changes are
+# half as large as the snapshot.
+MAX_DELTAS = 20
+
+# Removed links are remembered, so that other members don't share them
+# again, for this long and at most this many of them.
+TOMBSTONE_TTL = 30 * 24 * 60 * 60
+MAX_TOMBSTONES = 1000
+
+# Keys of data changed by the links added and removed, rather than set.
+_LINK_KEYS = ('shared_links', 'deleted', 'deleted_times')
+
+# Sections of the binary format with the state of the tabs, and the
+# keys of data each one holds.  They come first in the file, so that
+# the tabs are restored before the links are decoded.
+_TAB_SECTIONS = [('current', ('current_tab', 'currents')),
+                 ('tabs', ('history',))]
+_TAB_KEYS = tuple(key for name, keys in _TAB_SECTIONS for key in keys)
+
+
+def link_hash(url):
+    ''' The identifier of the link to url '''
+    return sha1(str(url)).hexdigest()
+
 
 class Model(GObject.GObject):
     ''' The model of web-activity which uses json to serialize its data
     to a file and deserealize from it.
+
+    The file is a log, one JSON object per line: a snapshot of the data
+    followed by the changes made since, so that saving only serializes
+    what changed.  Without changes it is a single JSON object, as written
+    by older versions.
+
+    serialize_session() writes the binary format of sessionfile instead,
+    where that log only holds the links, in a section after the state of
+    the tabs.  deserialize() reads both formats, the links of the binary
+    one are read by load_links() or when they are first used.
+
+    Both formats carry the thumbnails of the links, so that entries
+    keep them on other computers and the ThumbnailStore, shared by all
+    the entries, only caches them.
     '''
     __gsignals__ = {
         'add_link': (GObject.SignalFlags.RUN_FIRST,
                      None, ([int])),
         }
 
-    def __init__(self):
+    def __init__(self, thumbnails):
         GObject.GObject.__init__(self)
+        # The ThumbnailStore caching the thumbnails of the links, they
+        # only keep the key of their thumbnail.
+        self.thumbnails = thumbnails
         self.data = {}
         self.data['shared_links'] = []
         self.data['deleted'] = []
+        self.data['deleted_times'] = []
+        self._index_links()
+        self._reset_log(None)
+        # The binary file read last, whose links are read when needed.
+        self._session = None
+        self._links_pending = False
+        # The thumbnails of the entry read last, by key, used when they
+        # are not in the store: base64 strings from JSON, or the
+        # thumbnails section of the binary file, unpacked when first
+        # used.
+        self._entry_thumbnails = {}
+        self._session_thumbnails = None
+        # The keys of the thumbnails of the links, and the
+        # (key, thumbnail) pairs last read for them.
+        self._link_thumbnails_cache = ((), [])
+
+    def _reset_log(self, snapshot, skip=()):
+        ''' Start the log of changes to the snapshot, a serialized
+        version of data without the keys in skip, or None to have the
+        next serialize() write one.
+        '''
+        self._snapshot = snapshot
+        self._log_skip = skip
+        # The serialized changes made since the snapshot.
+        self._deltas = []
+        # The other values of data, as last serialized.  They must be
+        # replaced when they change, not changed in place.
+        self._saved = {}
+        for key, value in self.data.iteritems():
+            if key not in _LINK_KEYS and key not in skip:
+                self._saved[key] = value
+        # The links added or removed since the last serialize(), as
+        # ['add', link] or ['remove', hash, time removed] lists.
+        self._link_changes = []
+
+    def _index_links(self):
+        ''' Index the links of data, which are kept sorted by timestamp.
+        The indexes are not serialized.  Return whether the removed
+        links of data had to be converted from an older version.
+        '''
+        links = self.data['shared_links']
+        links.sort(key=lambda link: link['timestamp'])
+        # The timestamps of the links, in the same order, to bisect.
+        self._timestamps = [link['timestamp'] for link in links]
+        # The links with each hash, in the same order.  Links received
+        # from other members can be there more than once.
+        self._links = {}
+        for link in links:
+            self._links.setdefault(link['hash'], []).append(link)
+
+        # The hashes of the removed links, oldest first, and the time
+        # they were removed.  Older versions kept no times, and a hash
+        # once per link removed.
+        deleted = self.data.setdefault('deleted', [])
+        times = self.data.setdefault('deleted_times', [])
+        self._deleted = dict(zip(deleted, times))
+        if len(self._deleted) != len(deleted):
+            now = time.time()
+            self.data['deleted'] = []
+            self.data['deleted_times'] = []
+            self._deleted = {}
+            for i, hash in enumerate(deleted):
+                if i < len(times):
+                    self._add_tombstone(hash, times[i])
+                else:
+                    self._add_tombstone(hash, now)
+            return True
+        return False
 
     def add_link(self, url, title, thumb, owner, color, timestamp):
-        index = len(self.data['shared_links'])
-        for item in self.data['shared_links']:
-            if timestamp <= item['timestamp']:
-                index = self.data['shared_links'].index(item)
-                break
-
-        info = {'hash': sha.new(str(url)).hexdigest(), 'url': str(url),
-                'title': str(title), 'thumb': base64.b64encode(thumb),
+        self.load_links()
+        if thumb:
+            thumb_key = self.thumbnails.put(thumb)
+        else:
+            thumb_key = None
+        info = {'hash': link_hash(url), 'url': str(url),
+                'title': str(title), 'thumb_key': thumb_key,
                 'owner': str(owner), 'color': str(color),
                 'timestamp': float(timestamp)}
-        self.data['shared_links'].insert(index, info)
+        index = self._insert_link(info)
+        self._link_changes.append(['add', info])
         self.emit('add_link', index)
 
+    def _insert_link(self, info):
+        timestamp = info['timestamp']
+        index = bisect.bisect_left(self._timestamps, timestamp)
+        self.data['shared_links'].insert(index, info)
+        self._timestamps.insert(index, timestamp)
+        same_hash = self._links.setdefault(info['hash'], [])
+        position = 0
+        while position < len(same_hash) and \
+                same_hash[position]['timestamp'] < timestamp:
+            position += 1
+        same_hash.insert(position, info)
+        return index
+
     def remove_link(self, hash):
+        self.load_links()
+        removed = time.time()
+        if self._remove_link(hash, removed):
+            self._link_changes.append(['remove', hash, removed])
+
+    def _remove_link(self, hash, removed=None):
+        same_hash = self._links.get(hash)
+        if same_hash is None:
+            return False
+        link = same_hash.pop(0)
+        if not same_hash:
+            del self._links[hash]
+
+        # Only the links with the same timestamp are compared.
+        links = self.data['shared_links']
+        index = bisect.bisect_left(self._timestamps, link['timestamp'])
+        while links[index] is not link:
+            index += 1
+        del links[index]
+        del self._timestamps[index]
+        self._add_tombstone(hash, removed or time.time())
+        return True
+
+    def _add_tombstone(self, hash, removed):
+        if hash not in self._deleted:
+            self.data['deleted'].append(hash)
+            self.data['deleted_times'].append(removed)
+            self._deleted[hash] = removed
+
+    def _expire_tombstones(self):
+        ''' Forget the links removed more than TOMBSTONE_TTL ago, and
+        the oldest ones past MAX_TOMBSTONES.  Return whether any was.
+        '''
+        deleted = self.data['deleted']
+        times = self.data['deleted_times']
+        horizon = time.time() - TOMBSTONE_TTL
+        if len(deleted) <= MAX_TOMBSTONES and \
+                (not times or times[0] >= horizon):
+            return False
+
+        # The times are only in order as long as the clock is.
+        kept = [(hash, removed) for hash, removed in zip(deleted, times)
+                if removed >= horizon][-MAX_TOMBSTONES:]
+        self.data['deleted'] = [hash for hash, removed in kept]
+        self.data['deleted_times'] = [removed for hash, removed in kept]
+        self._deleted = dict(kept)
+        return True
+
+    def get_link(self, hash):
+        ''' Return the shared link with hash, or None '''
+        self.load_links()
+        same_hash = self._links.get(hash)
+        if same_hash is None:
+            return None
+        return same_hash[0]
+
+    def get_thumbnail(self, link):
+        ''' Return the PNG thumbnail of link, or None if it is not
+        available
+        '''
+        if 'thumb' in link:
+            # Older versions stored the thumbnail itself in base64, it
+            # is moved to the store the first time it is used.
+            thumb = base64.b64decode(link.pop('thumb'))
+            link['thumb_key'] = self.thumbnails.put(thumb)
+            return thumb
+
+        key = link.get('thumb_key')
+        if key is None:
+            return None
+        thumb = self.thumbnails.get(key)
+        if thumb is None:
+            # Not cached yet, or swept since.
+            thumb = self._entry_thumbnail(key)
+            if thumb is not None:
+                self.thumbnails.put(thumb)
+        return thumb
+
+    def _entry_thumbnail(self, key):
+        if key in self._entry_thumbnails:
+            return base64.b64decode(self._entry_thumbnails[key])
+        if self._session is None:
+            return None
+        if self._session_thumbnails is None:
+            self._session_thumbnails = sessionfile.unpack_blobs(
+                self._session.get('thumbnails') or '')
+        return self._session_thumbnails.get(key)
+
+    def thumbnail_keys(self):
+        ''' Return the keys of the thumbnails of the shared links '''
+        self.load_links()
+        keys = []
         for link in self.data['shared_links']:
-            if link['hash'] == hash:
-                self.data['deleted'].append(link['hash'])
-                self.data['shared_links'].remove(link)
-                break
+            if 'thumb' in link:
+                # Moves the thumbnail of older versions to the store.
+                self.get_thumbnail(link)
+            if link.get('thumb_key') is not None and \
+                    link['thumb_key'] not in keys:
+                keys.append(link['thumb_key'])
+        return keys
+
+    def knows_link(self, hash):
+        ''' Return whether the link with hash is shared or was deleted '''
+        self.load_links()
+        return hash in self._links or hash in self._deleted
 
     def serialize(self):
-        return json.dumps(self.data)
+        self.load_links()
+        return self._serialize_log((), True)
+
+    def serialize_session(self):
+        ''' Return data in the binary format of sessionfile '''
+        self.load_links()
+        sections = []
+        for name, keys in _TAB_SECTIONS:
+            sections.append((name, json.dumps(dict(
+                (key, self.data[key]) for key in keys if key in self.data))))
+        sections.append(('links', self._serialize_log(_TAB_KEYS, False)))
+        sections.append(('thumbnails', sessionfile.pack_blobs(
+            self._link_thumbnails())))
+        return sessionfile.pack_sections(sections)
+
+    def _link_thumbnails(self):
+        ''' Return the (key, thumbnail) pairs of the shared links '''
+        keys = tuple(self.thumbnail_keys())
+        if keys != self._link_thumbnails_cache[0]:
+            thumbs = {}
+            for link in self.data['shared_links']:
+                if link.get('thumb_key') not in thumbs:
+                    thumb = self.get_thumbnail(link)
+                    if thumb is not None:
+                        thumbs[link['thumb_key']] = thumb
+            self._link_thumbnails_cache = (keys, thumbs.items())
+        return self._link_thumbnails_cache[1]
+
+    def _serialize_log(self, skip, thumbnails):
+        ''' Return the log of data without the keys in skip, and with
+        the thumbnails of the links if thumbnails is True '''
+        if skip != self._log_skip:
+            self._snapshot = None
+        if self._expire_tombstones():
+            # The log only records the links removed, not forgotten.
+            self._snapshot = None
+
+        delta = {}
+        for key, value in self.data.iteritems():
+            if key not in _LINK_KEYS and key not in skip and \
+                    (key not in self._saved or self._saved[key] != value):
+                delta[key] = value
+                self._saved[key] = value
+
+        if delta or self._link_changes:
+            added = {}
+            for change in self._link_changes:
+                if thumbnails and change[0] == 'add' and \
+                        change[1]['thumb_key'] is not None:
+                    thumb = self.get_thumbnail(change[1])
+                    if thumb is not None:
+                        added[change[1]['thumb_key']] = \
+                            base64.b64encode(thumb)
+            self._deltas.append(json.dumps({'set': delta,
+                                            'links': self._link_changes,
+                                            'thumbnails': added}))
+            self._link_changes = []
+
+        if self._snapshot is None or len(self._deltas) > MAX_DELTAS or \
+                sum(map(len, self._deltas)) * 2 > len(self._snapshot):
+            snapshot = dict((key, value)
+                            for key, value in self.data.iteritems()
+                            if key not in skip)
+            if thumbnails:
+                snapshot['thumbnails'] = dict(
+                    (key, base64.b64encode(thumb))
+                    for key, thumb in self._link_thumbnails())
+            self._reset_log(json.dumps(snapshot), skip)
+            return self._snapshot
+        return '\n'.join([self._snapshot] + self._deltas)
 
     def deserialize(self, data):
-        self.data = json.loads(data)
+        self._session = None
+        self._links_pending = False
+        self._entry_thumbnails = {}
+        self._session_thumbnails = None
+        if not sessionfile.is_session(data):
+            self._load_log(data, ())
+            return
+
+        self._session = sessionfile.SessionFile(data)
+        self.data = {'shared_links': [], 'deleted': []}
+        for name, keys in _TAB_SECTIONS:
+            if name in self._session:
+                section = json.loads(self._session.get(name))
+                for key in keys:
+                    if key in section:
+                        self.data[key] = section[key]
+        self._index_links()
+        self._links_pending = 'links' in self._session
+
+    def load_links(self):
+        ''' Read the links of the binary file last deserialized, if
+        they were not read yet
+        '''
+        if self._links_pending:
+            self._links_pending = False
+            self._load_log(self._session.get('links'), _TAB_KEYS)
+
+    def _load_log(self, data, skip):
+        ''' Read a log written by _serialize_log(), keeping the values
+        of the keys in skip '''
+        lines = data.split('\n')
+        kept = dict((key, self.data[key]) for key in skip
+                    if key in self.data)
+        self.data = json.loads(lines[0])
+        self.data.update(kept)
         self.data.setdefault('shared_links', [])
-        self.data.setdefault('deleted', [])
+        self._entry_thumbnails = self.data.pop('thumbnails', {})
+        converted = self._index_links()
+
+        deltas = [line for line in lines[1:] if line]
+        for line in deltas:
+            delta = json.loads(line)
+            self.data.update(delta['set'])
+            self._entry_thumbnails.update(delta.get('thumbnails', {}))
+            for change in delta['links']:
+                if change[0] == 'add':
+                    self._insert_link(change[1])
+                else:
+                    self._remove_link(*change[1:])
+
+        if converted:
+            # The next save writes a snapshot with the times given to
+            # the removed links, or they would get new ones on every
+            # load and never expire.
+            self._reset_log(None, skip)
+        else:
+            # Saving again appends to the same log.
+            self._reset_log(lines[0], skip)
+            self._deltas = deltas
 
     def get_links_ids(self):
+        self.load_links()
         ids = []
         for link in self.data['shared_links']:
             ids.append(link['hash'])
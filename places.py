@@ -14,34 +14,522 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import calendar
+import collections
+import itertools
+import logging
+import math
 import os
+import re
 import sqlite3
-from datetime import datetime, timedelta
-
-from sugar3.activity import activity
+import time
 
 _store = None
 
+_MS_PER_DAY = 24 * 60 * 60 * 1000
+
+# Frecency is the sum of the weights of the visits to a place, each
+# halved every FRECENCY_HALF_LIFE milliseconds.  See frecency_visit().
+FRECENCY_HALF_LIFE = 7 * _MS_PER_DAY
+VISIT_WEIGHT = 1.0
+TYPED_VISIT_WEIGHT = 2.0
+
+# How the user got to a page, stored with each visit in the visits
+# log.
+TRANSITION_LINK = 0
+TRANSITION_TYPED = 1
+_TRANSITION_WEIGHTS = {TRANSITION_LINK: VISIT_WEIGHT,
+                       TRANSITION_TYPED: TYPED_VISIT_WEIGHT}
+
+# Version of the places database schema, stored in the user_version
+# pragma.  Each increment has a matching SqliteStore._migrate_to_<n>
+# method that upgrades a database from the previous version.
+SCHEMA_VERSION = 9
+
+# Seconds to wait for the write lock of the database, held by other
+# Browse instances, before giving up.
+_BUSY_TIMEOUT = 2.0
+# Seconds to wait for another Browse instance migrating the schema of
+# a large history before giving up.
+_MIGRATION_TIMEOUT = 120.0
+
+# Maintenance tasks of the database, run by SqliteStore.maintain(),
+# with the days to wait between runs of each one and whether they can
+# run in idle time.  Checking a table can't be interrupted, so the
+# quick check only runs when the activity closes.
+_MAINTENANCE_TASKS = [('vacuum', 1, True), ('analyze', 7, True),
+                      ('quick_check', 30, False)]
+# Free pages returned to the file system per transaction of the
+# incremental vacuum.
+_VACUUM_PAGES = 256
+# Bytes per second a full vacuum is expected to rewrite, to tell
+# whether it fits in the time left.
+_VACUUM_RATE = 20 * 1024 * 1024
+# SQLite version that can check a single table, older ones check the
+# whole database at once.
+_QUICK_CHECK_TABLE_VERSION = (3, 33, 0)
+# Rows of each index sampled by ANALYZE.
+_ANALYSIS_LIMIT = 1000
+
+# Characters the FTS 'simple' tokenizer considers part of a token.
+_TOKEN_RE = re.compile(u'[0-9A-Za-z\u0080-\uffff]+')
+
+# Posting lists of the trigram index longer than this are not worth
+# intersecting, the Searcher scans places by frecency instead.
+_MAX_TRIGRAM_POSTINGS = 1000
+# Posting lists intersected for a search.
+_MAX_TRIGRAMS = 3
+
+# Query parameters that only tell where the user came from, dropped
+# from canonical uris.  Parameters starting with utm_ are dropped too.
+_TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'dclid', 'msclkid',
+                              'yclid', 'mc_cid', 'mc_eid', 'igshid',
+                              '_ga', '_hsenc', '_hsmi'])
+_DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+# Both FTS and LIKE only fold the case of ASCII letters.
+_ASCII_LOWER = dict((ord(c), ord(c.lower()))
+                    for c in u'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
 
 class Place(object):
+    # Slots keep places small, there can be thousands of them in
+    # search candidates and bulk reads.
+    __slots__ = ('uri', 'title', 'bookmark', 'gecko_flags', 'visits',
+                 'last_visit', 'frecency')
+
     def __init__(self, uri=''):
         self.uri = uri
         self.title = ''
         self.bookmark = False
         self.gecko_flags = 0
         self.visits = 0
-        self.last_visit = datetime.now()
+        self.last_visit = now()
+        self.frecency = 0.0
+
+
+def canonical_uri(uri):
+    """Return the key of the page at uri, the same for every uri that
+    shows the same page.
+
+    The scheme of web pages is dropped, as http and https versions of
+    a page are the same page, and so are their host case, default
+    port, trailing slashes, fragment and tracking parameters.  Other
+    uris are their own key.
+    """
+    if uri is None:
+        return None
+    scheme, separator, rest = uri.partition('://')
+    if not separator or scheme.lower() not in ('http', 'https'):
+        return uri
+
+    rest, hash_, fragment = rest.partition('#')
+    rest, question, query = rest.partition('?')
+    host, slash, path = rest.partition('/')
+    host = host.lower().rstrip('.')
+    if host.endswith(_DEFAULT_PORTS[scheme.lower()]):
+        host = host.rpartition(':')[0]
+
+    key = host
+    path = path.rstrip('/')
+    if path:
+        key += '/' + path
+    if query:
+        params = [param for param in query.split('&') if param]
+        params = [param for param in params
+                  if not param.startswith('utm_') and
+                  param.partition('=')[0] not in _TRACKING_PARAMS]
+        if params:
+            key += '?' + '&'.join(params)
+    # Pages that route with the fragment mark it with !, like #!/page.
+    if fragment.startswith('!'):
+        key += '#' + fragment
+    return key
+
+
+def _is_https_upgrade(uri, new_uri):
+    """Return whether new_uri is an https uri replacing the http uri of
+    the same place.  Other versions of a page, like the ones with
+    tracking parameters, don't replace the uri of its place."""
+    return uri.lower().startswith('http://') and \
+        new_uri.lower().startswith('https://')
+
+
+def now():
+    """Return the current time as used for Place.last_visit, integer
+    milliseconds since the epoch."""
+    return int(time.time() * 1000)
+
+
+def frecency_visit(weight, timestamp):
+    """Return the frecency of a single visit of the given weight.
+
+    To be able to compare the frecency of places visited at different
+    times, without decaying every place on every visit, the stored
+    value is the log2 of the score the visits would have at the epoch
+    (so it grows by one every half life).  Adding visits is then
+    frecency_add() and the ordering is the same at any time.
+    """
+    return math.log(weight, 2) + float(timestamp) / FRECENCY_HALF_LIFE
+
+
+def frecency_add(frecency, other):
+    """Return the frecency of the visits of frecency and other."""
+    if frecency is None:
+        return other
+    if other is None:
+        return frecency
+    high, low = max(frecency, other), min(frecency, other)
+    return high + math.log(1 + 2 ** (low - high), 2)
+
+
+class _FrecencySum(object):
+    """SQL aggregate of the frecency of visits, given their transition
+    and visit_time."""
+
+    def __init__(self):
+        self._frecency = None
+
+    def step(self, transition, visit_time):
+        weight = _TRANSITION_WEIGHTS.get(transition, VISIT_WEIGHT)
+        self._frecency = frecency_add(self._frecency,
+                                      frecency_visit(weight, visit_time))
+
+    def finalize(self):
+        return self._frecency
+
+
+def _partition(visit_time):
+    """Return the name of the table of the visits log that stores the
+    visits of the month of visit_time, in UTC."""
+    year, month = time.gmtime(visit_time / 1000)[:2]
+    return 'visits_%04d%02d' % (year, month)
+
+
+def _partition_range(name):
+    """Return the start and end times of the visits stored in the
+    partition name."""
+    year, month = int(name[7:11]), int(name[11:13])
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    year, month = year + month / 12, month % 12 + 1
+    end = calendar.timegm((year, month, 1, 0, 0, 0))
+    return start * 1000, end * 1000
+
+
+# Columns of places read by _place_factory().  Previous versions of
+# Browse were allowing to store None for uri and title, see ticket
+# #3400, and new places have no frecency until their visits are
+# rolled up.
+_PLACE_COLUMNS = ("coalesce(uri, ''), coalesce(title, ''), "
+                  'coalesce(bookmark, 0), coalesce(gecko_flags, 0), '
+                  'coalesce(visits, 0), coalesce(last_visit, 0), '
+                  'coalesce(frecency, 0.0)')
+
+_new_place = object.__new__
+
+
+def _place_factory(cursor, row):
+    # The row is assigned as is, without building an intermediate
+    # Place() first.
+    place = _new_place(Place)
+    (place.uri, place.title, place.bookmark, place.gecko_flags,
+     place.visits, place.last_visit, place.frecency) = row
+    return place
+
+
+class _KeysetCursor(sqlite3.Cursor):
+    """Cursor reading places followed by their rowid, with
+    _keyset_place_factory(), which keeps the last rowid read."""
+    last_id = 0
+
+
+def _keyset_place_factory(cursor, row):
+    place = _new_place(Place)
+    (place.uri, place.title, place.bookmark, place.gecko_flags,
+     place.visits, place.last_visit, place.frecency, cursor.last_id) = row
+    return place
+
+
+def trigrams(text):
+    """Return the set of trigrams of text, as stored in the trigram
+    index."""
+    text = _to_unicode(text).translate(_ASCII_LOWER)
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def matches(place, text, fts=True):
+    """Return whether a Searcher would find place when searching for
+    text, fts telling whether it has a full-text index."""
+    text = _to_unicode(text).translate(_ASCII_LOWER)
+    uri = _to_unicode(place.uri).translate(_ASCII_LOWER)
+    title = _to_unicode(place.title).translate(_ASCII_LOWER)
+
+    if not fts:
+        return text in uri or text in title
+    if text in uri:
+        return True
+
+    tokens = _TOKEN_RE.findall(text)
+    if not tokens:
+        return False
+
+    words = _TOKEN_RE.findall(uri) + _TOKEN_RE.findall(title)
+    for token in tokens:
+        for word in words:
+            if word.startswith(token):
+                break
+        else:
+            return False
+    return True
+
+
+def _to_unicode(text):
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+def _is_busy(error):
+    """Return whether error is SQLite giving up waiting for a lock."""
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def _place_cursor(connection):
+    cursor = connection.cursor()
+    cursor.row_factory = _place_factory
+    return cursor
+
+
+class PlaceCache(object):
+    """The size most recently used places, by canonical_uri() of
+    their uri.
+
+    hits and misses count the lookups found in the cache or not.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._places = collections.OrderedDict()
+
+    def get(self, key):
+        place = self._places.pop(key, None)
+        if place is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._places[key] = place
+        return place
+
+    def peek(self, key):
+        """Return the place of key without counting a lookup or making
+        it recently used."""
+        return self._places.get(key)
+
+    def put(self, place):
+        key = canonical_uri(place.uri)
+        self._places.pop(key, None)
+        self._places[key] = place
+        if len(self._places) > self.size:
+            self._places.popitem(last=False)
+
+    def clear(self):
+        self._places.clear()
+
+    def __len__(self):
+        return len(self._places)
+
+
+class Searcher(object):
+    """Search places through a connection.
+
+    A place matches when every word of the text is the prefix of a
+    word of its uri or title, found with the full-text index, or when
+    the text is part of its uri.  The latter uses the trigram index
+    when the text has rare enough trigrams, see _plan_trigrams().
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute('select name from sqlite_master where name in '
+                           '("places_fts", "places_trigrams")')
+            tables = [row[0] for row in cursor]
+        finally:
+            cursor.close()
+
+        self.has_fts = 'places_fts' in tables
+        self.has_trigrams = 'places_trigrams' in tables
+
+    def interrupt(self):
+        """Abort the search running in another thread, it will raise
+        sqlite3.OperationalError."""
+        self._connection.interrupt()
+
+    def search(self, text, limit):
+        """Return the limit places with the highest frecency that
+        match text."""
+        if not self.has_fts:
+            return self._search_like(text, limit)
+
+        match = self._fts_query(text)
+        like = '%' + _escape_like(text) + '%'
+        trigram_list = self._plan_trigrams(text)
+        cursor = _place_cursor(self._connection)
+
+        try:
+            if match:
+                fts = 'select docid from places_fts where places_fts match ?'
+                params = [match]
+            else:
+                fts = 'select null'
+                params = []
+
+            if trigram_list is None:
+                # Matching places are common, scanning them by frecency
+                # stops early.
+                cursor.execute('select %s from places '
+                               'where rowid in (%s) or '
+                               "uri like ? escape '\\' "
+                               'order by frecency desc limit 0, ?' %
+                               (_PLACE_COLUMNS, fts),
+                               params + [like, limit])
+            else:
+                # Places waiting in the queue are not in the trigram
+                # index yet.
+                postings = ' intersect '.join(
+                    ['select place from places_trigrams where trigram=?'] *
+                    len(trigram_list))
+                cursor.execute('select %s from places '
+                               'where rowid in (%s union '
+                               'select rowid from places where rowid in '
+                               "(%s) and uri like ? escape '\\' union "
+                               'select place from places_trigram_queue '
+                               'cross join places on places.rowid=place '
+                               "where uri like ? escape '\\') "
+                               'order by frecency desc limit 0, ?' %
+                               (_PLACE_COLUMNS, fts, postings),
+                               params + trigram_list + [like, like, limit])
+
+            result = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        return result
+
+    def _plan_trigrams(self, text):
+        """Return the trigrams of text with the shortest posting lists,
+        or None if the trigram index won't help finding text.
+
+        Only the first _MAX_TRIGRAM_POSTINGS entries of each posting
+        list are counted, so planning costs little even for trigrams
+        that are in most uris.
+        """
+        if not self.has_trigrams:
+            return None
+
+        counts = []
+        cursor = self._connection.cursor()
+        try:
+            for trigram in trigrams(text):
+                cursor.execute('select count(*) from (select 1 from '
+                               'places_trigrams where trigram=? limit ?)',
+                               (trigram, _MAX_TRIGRAM_POSTINGS))
+                count = cursor.fetchone()[0]
+                if count < _MAX_TRIGRAM_POSTINGS:
+                    counts.append((count, trigram))
+        finally:
+            cursor.close()
+
+        if not counts:
+            return None
+        counts.sort()
+        return [trigram for count_, trigram in counts[:_MAX_TRIGRAMS]]
+
+    def _search_like(self, text, limit):
+        cursor = _place_cursor(self._connection)
+
+        try:
+            text = '%' + text + '%'
+            cursor.execute('select %s from places '
+                           'where uri like ? or title like ? '
+                           'order by frecency desc limit 0, ?' %
+                           _PLACE_COLUMNS, (text, text, limit))
+
+            result = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        return result
+
+    def _fts_query(self, text):
+        """Build a full-text query matching every word of text as a
+        prefix of a word in the uri or title.
+
+        Each word is quoted so that words like OR or NOT are not taken
+        as query operators.
+        """
+        return ' '.join(['"%s*"' % token for token in _TOKEN_RE.findall(text)])
 
 
 class SqliteStore(object):
     MAX_SEARCH_MATCHES = 7
     EXPIRE_DAYS = 30
+    # Number of places with queued writes that triggers a flush.
+    MAX_PENDING = 32
+    # Places read or written per transaction by iter_places() and
+    # import_places().
+    BULK_BATCH = 10000
+    # Places kept by lookup_place(), see PlaceCache.
+    PLACE_CACHE_SIZE = 100
 
-    def __init__(self):
-        db_path = os.path.join(activity.get_activity_root(),
-                               'data', 'places.db')
+    def __init__(self, db_path=None):
+        if db_path is None:
+            # Imported here so that places can be used without Sugar,
+            # by the benchmarks.
+            from sugar3.activity import activity
+            db_path = os.path.join(activity.get_activity_root(),
+                                   'data', 'places.db')
+        self._db_path = db_path
+
+        self._connection = self._connect()
+        # Pages freed by deletes are given back by the incremental
+        # vacuum of maintain().  This only applies to new databases,
+        # and must come before the journal mode is set.  Setting it
+        # takes the write lock, that another instance may hold, so
+        # it is left alone on existing databases.
+        cursor = self._connection.execute('pragma page_count')
+        if cursor.fetchone()[0] == 0:
+            self._connection.execute('pragma auto_vacuum=incremental')
+        self._set_journal_mode()
 
-        self._connection = sqlite3.connect(db_path)
+        self._connection.create_function('frecency_add', 2, frecency_add)
+        self._connection.create_function('frecency_visit', 2,
+                                         frecency_visit)
+        self._connection.create_aggregate('frecency_sum', 2, _FrecencySum)
+        self._connection.create_function('canonical_uri', 1, canonical_uri)
+        # Visits and titles waiting to be written, by canonical uri,
+        # as [visits, title, uri] lists, visits being a list of
+        # (visit_time, transition) tuples and uri the one to store,
+        # see _is_https_upgrade().
+        self._pending = {}
+        # Places known to lookup_place(), kept up to date by the
+        # writes of this store and dropped when another connection
+        # writes.
+        self.place_cache = PlaceCache(self.PLACE_CACHE_SIZE)
+        self._cache_version = None
+        # The last result of get_data_version(), for the callers that
+        # must not query the database, like the URL entry on every
+        # keystroke.
+        self.data_version = None
         cursor = self._connection.cursor()
 
         cursor.execute('select * from sqlite_master where name == "places"')
@@ -49,7 +537,7 @@ class SqliteStore(object):
             # Create table to store the visited places.  Note that
             # bookmark and gecko_flags fields aren't used anymore in
             # WebKit port, but are kept for backwards compatibility.
-            cursor.execute("""create table places (
+            cursor.execute("""create table if not exists places (
                                 uri         text,
                                 title       text,
                                 bookmark    boolean,
@@ -58,95 +546,1211 @@ class SqliteStore(object):
                                 last_visit  timestamp
                               );
                            """)
+
+        self._partitions = []
+        cursor.execute('pragma user_version')
+        if cursor.fetchone()[0] < SCHEMA_VERSION:
+            self._migrate_schema()
+        self._list_partitions(cursor)
+        self._searcher = Searcher(self._connection)
+
+    def _connect(self):
+        """Return a new connection to the database."""
+        return sqlite3.connect(self._db_path, timeout=_BUSY_TIMEOUT)
+
+    def _set_journal_mode(self):
+        # Every Browse instance uses the same database.  With WAL, a
+        # writer doesn't block the readers, and commits only wait for
+        # the other writers, up to _BUSY_TIMEOUT.
+        try:
+            cursor = self._connection.execute('pragma journal_mode=wal')
+            journal_mode = cursor.fetchone()[0]
+        except sqlite3.OperationalError, e:
+            journal_mode = str(e)
+        if journal_mode != 'wal':
+            logging.warning('Places database not in WAL mode: %s',
+                            journal_mode)
         else:
-            self._cleanup()
+            # Only the last commits can be lost on power failure, the
+            # database stays consistent.
+            self._connection.execute('pragma synchronous=normal')
 
     def search(self, text):
+        self.flush()
+        return self._searcher.search(text, self.MAX_SEARCH_MATCHES)
+
+    def create_searcher(self):
+        """Return a Searcher with its own connection to the database.
+
+        The Searcher must only be used from the thread that called
+        this method.  It doesn't see the writes queued in this store
+        until they are flushed.
+        """
+        return Searcher(self._connect())
+
+    def queued_places(self):
+        """Return the places of the visits queued until the next
+        flush(), counting only those visits.
+
+        They are what the Searchers of create_searcher() can't see
+        yet, to be merged with their results without writing.
+        """
+        result = []
+        for visits, title, uri in self._pending.itervalues():
+            if not visits:
+                continue
+            # Like the places read from the database.
+            place = Place(_to_unicode(uri))
+            place.title = _to_unicode(title or u'')
+            place.visits = len(visits)
+            place.last_visit = max([visit_time
+                                    for visit_time, transition_ in visits])
+            place.frecency = None
+            for visit_time, transition in visits:
+                place.frecency = frecency_add(
+                    place.frecency,
+                    frecency_visit(_TRANSITION_WEIGHTS[transition],
+                                   visit_time))
+            result.append(place)
+        return result
+
+    def get_data_version(self):
+        """Return a number that changes when another connection, like
+        the one of another Browse instance, commits to the database.
+
+        Caches of the places compare it with the number they were
+        built with to know when to reload.  SQLite older than 3.8.4
+        doesn't tell, the number is None and caches are never
+        reloaded.
+        """
         cursor = self._connection.cursor()
 
         try:
-            text = '%' + text + '%'
-            cursor.execute('select uri, title, bookmark, gecko_flags, '
-                           'visits, last_visit from places '
-                           'where uri like ? or title like ? '
-                           'order by visits desc limit 0, ?',
-                           (text, text, self.MAX_SEARCH_MATCHES))
-
-            result = [self._place_from_row(row) for row in cursor]
+            cursor.execute('pragma data_version')
+            row = cursor.fetchone()
         finally:
             cursor.close()
 
-        return result
+        if row is None:
+            self.data_version = None
+        else:
+            self.data_version = row[0]
+        return self.data_version
 
     def add_place(self, place):
+        """Add place to places.  The visits queued for its uri are
+        logged to it by the next flush(), and added to its visits by
+        the rollup."""
+        key = canonical_uri(place.uri)
+        pending = self._pending.get(key)
+        if pending is not None:
+            # Set after the queued title.
+            pending[1] = None
+        if self._write(self._add_place, place) is not None and \
+                (pending is None or not pending[0]):
+            self.place_cache.put(place)
+
+    def _add_place(self, cursor, place):
+        cursor.execute('insert into places (uri, uri_key, title, bookmark, '
+                       'gecko_flags, visits, last_visit, frecency) '
+                       'values (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (place.uri, canonical_uri(place.uri), place.title,
+                        place.bookmark, place.gecko_flags, place.visits,
+                        place.last_visit, place.frecency))
+        self._index_trigrams(cursor, places=[cursor.lastrowid])
+
+    def lookup_place(self, uri):
+        """Return the place of uri, or None.
+
+        The place is the one of canonical_uri(uri), its uri may be
+        another version of uri.  Places are cached, and the same Place
+        is returned until it is evicted, so it must only be changed
+        through update_place().
+        """
+        version = self.get_data_version()
+        if version != self._cache_version:
+            self.place_cache.clear()
+            self._cache_version = version
+
+        key = canonical_uri(uri)
+        place = self.place_cache.get(key)
+        if place is not None:
+            return place
+
+        self.flush()
+        self.rollup(-1)
+        cursor = _place_cursor(self._connection)
+
+        try:
+            cursor.execute('select %s from places where uri_key=?' %
+                           _PLACE_COLUMNS, (key,))
+
+            place = cursor.fetchone()
+        finally:
+            cursor.close()
+
+        if place is not None:
+            self.place_cache.put(place)
+        return place
+
+    def update_place(self, place):
+        """Write the title, bookmark and gecko_flags of place.
+
+        Its visits, last_visit and frecency are left alone: they are
+        added up from the visits log by the rollup, including the
+        visits a place from lookup_place() already counts.
+        """
+        self.flush()
+        if self._write(self._update_place, place) is not None:
+            cached = self.place_cache.peek(canonical_uri(place.uri))
+            if cached is not None:
+                cached.title = place.title
+                cached.bookmark = place.bookmark
+                cached.gecko_flags = place.gecko_flags
+
+    def _update_place(self, cursor, place):
+        cursor.execute('update places set title=?, gecko_flags=?, '
+                       'bookmark=? where uri_key=?',
+                       (place.title, place.gecko_flags, place.bookmark,
+                        canonical_uri(place.uri)))
+
+    def add_visit(self, uri, typed=False):
+        """Record a visit to uri, adding it to places if no place has
+        the same canonical_uri().
+
+        Visits to addresses typed by the user weigh more in the
+        frecency of the place.  The visit is queued and written to the
+        visits log by the next flush(), and added to the place by the
+        next rollup().
+        """
+        if typed:
+            transition = TRANSITION_TYPED
+        else:
+            transition = TRANSITION_LINK
+
+        visit_time = now()
+        key = canonical_uri(uri)
+        pending = self._pending.setdefault(key, [[], None, uri])
+        pending[0].append((visit_time, transition))
+        if _is_https_upgrade(pending[2], uri):
+            pending[2] = uri
+
+        # The cached place counts the visit now, as the rollup will.
+        place = self.place_cache.peek(key)
+        if place is not None:
+            if _is_https_upgrade(place.uri, uri):
+                place.uri = uri
+            place.visits += 1
+            place.last_visit = max(place.last_visit, visit_time)
+            place.frecency = frecency_add(
+                place.frecency,
+                frecency_visit(_TRANSITION_WEIGHTS[transition], visit_time))
+
+        if len(self._pending) >= self.MAX_PENDING:
+            self.flush()
+
+    def set_title(self, uri, title):
+        """Set the title of the place of uri, if it is in places.
+
+        The title is queued and written by the next flush().
+        """
+        key = canonical_uri(uri)
+        pending = self._pending.setdefault(key, [[], None, uri])
+        pending[1] = title
+        place = self.place_cache.peek(key)
+        if place is not None:
+            place.title = title
+        if len(self._pending) >= self.MAX_PENDING:
+            self.flush()
+
+    def flush(self):
+        """Write the queued visits and titles in one transaction.
+
+        If another Browse instance keeps the database locked, the
+        writes stay queued for the next flush.
+        """
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        partitions = set([_partition(visit_time)
+                          for visits, title_, uri_ in pending.itervalues()
+                          for visit_time, transition_ in visits])
+        if partitions.issubset(self._partitions) or \
+                self._schema_transaction(self._create_partitions,
+                                         partitions) is not None:
+            if self._write(self._flush, pending) is not None:
+                return
+
+        logging.warning('Places database busy, %d places kept queued',
+                        len(pending))
+        for key, (visits, title, uri) in pending.iteritems():
+            queued = self._pending.setdefault(key, [[], None, uri])
+            queued[0][:0] = visits
+            if queued[1] is None:
+                queued[1] = title
+            if _is_https_upgrade(queued[2], uri):
+                queued[2] = uri
+
+    def _flush(self, cursor, pending):
+        log = []
+        visited = []
+        for key, (visits, title, uri) in pending.iteritems():
+            if visits:
+                place = self._place_id(cursor, key, uri, visits[0][0])
+                visited.append(place)
+                log.extend([(place, visit_time, transition)
+                            for visit_time, transition in visits])
+            if title is not None:
+                cursor.execute('update places set title=? where uri_key=?',
+                               (title, key))
+        self._log_visits(cursor, log)
+        # Only the places added or renamed here, the rest of the queue
+        # is indexed in the background.
+        self._index_trigrams(cursor, places=visited)
+        return len(pending)
+
+    def rollup(self, limit):
+        """Add up to limit visits of the visits log to the visits,
+        last_visit and frecency of their places.
+
+        Return the number of visits rolled up, if it is less than limit
+        the places are up to date or the database is busy.
+        """
+        return self._write(self._rollup, limit) or 0
+
+    def count_visits(self, uri, since):
+        """Return the number of visits to the place of uri since the
+        given time, in milliseconds since the epoch, as long as they
+        haven't expired.
+        """
+        self.flush()
         cursor = self._connection.cursor()
 
         try:
-            cursor.execute('insert into places (uri, title, bookmark, '
-                           'gecko_flags, visits, last_visit) '
-                           'values (?, ?, ?, ?, ?, ?)',
-                           (place.uri, place.title, place.bookmark,
-                            place.gecko_flags, place.visits, place.last_visit))
-            self._connection.commit()
+            cursor.execute('select rowid from places where uri_key=?',
+                           (canonical_uri(uri),))
+            row = cursor.fetchone()
+            if row is None:
+                return 0
+            cursor.execute('select count(*) from visits '
+                           'where place=? and visit_time >= ?',
+                           (row[0], since))
+            return cursor.fetchone()[0]
         finally:
             cursor.close()
 
-    def lookup_place(self, uri):
+    def index_trigrams(self, limit):
+        """Add up to limit places waiting in the queue to the trigram
+        index.
+
+        Return the number of places indexed, if it is less than limit
+        the queue is empty.
+        """
+        return self._write(self._index_trigrams, limit) or 0
+
+    def _index_trigrams(self, cursor, limit=-1, places=None):
+        # Places are queued by triggers when they are added or their
+        # uri changes.  If places, a list of rowids, is given, only
+        # those of them in the queue are indexed.
+        if not self._searcher.has_trigrams:
+            return 0
+
+        if places is None:
+            cursor.execute('select place, uri from places_trigram_queue, '
+                           'places where places.rowid=place limit ?',
+                           (limit,))
+            rows = cursor.fetchall()
+        else:
+            rows = []
+            for place in places:
+                cursor.execute('select place, uri from places_trigram_queue, '
+                               'places where places.rowid=place and place=?',
+                               (place,))
+                rows.extend(cursor.fetchall())
+        for place, uri in rows:
+            cursor.execute('delete from places_trigrams where place=?',
+                           (place,))
+            cursor.executemany('insert into places_trigrams (trigram, place) '
+                               'values (?, ?)',
+                               [(trigram, place)
+                                for trigram in trigrams(uri or u'')])
+            cursor.execute('delete from places_trigram_queue where place=?',
+                           (place,))
+        return len(rows)
+
+    def save(self):
+        """Write the places to disk.  They already are, only the
+        writes queued until the next flush() are written."""
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+    def _write(self, function, *args):
+        """Return function(cursor, *args) run in a transaction.
+
+        The transaction takes the write lock first, so that what
+        function reads can't be changed by another Browse instance
+        before it writes.  Return None without running function if
+        the lock isn't released within _BUSY_TIMEOUT.
+        """
         cursor = self._connection.cursor()
 
         try:
-            cursor.execute('select uri, title, bookmark, gecko_flags,visits, '
-                           'last_visit from places where uri=?', (uri,))
+            cursor.execute('begin immediate')
+            result = function(cursor, *args)
+            self._connection.commit()
+        except sqlite3.Error, e:
+            self._connection.rollback()
+            if not _is_busy(e):
+                raise
+            logging.warning('Places database busy: %s', e)
+            return None
+        finally:
+            cursor.close()
 
-            row = cursor.fetchone()
-            if row:
-                return self._place_from_row(row)
-            else:
+        return result
+
+    def _schema_transaction(self, function, *args):
+        """Like _write(), for functions changing the schema.
+
+        sqlite3 commits before statements like create table, so the
+        transaction is handled here instead.
+        """
+        self._connection.commit()
+        self._connection.isolation_level = None
+        cursor = self._connection.cursor()
+
+        try:
+            try:
+                cursor.execute('begin immediate')
+            except sqlite3.OperationalError, e:
+                if not _is_busy(e):
+                    raise
+                logging.warning('Places database busy: %s', e)
                 return None
+
+            try:
+                result = function(cursor, *args)
+                cursor.execute('commit')
+            except BaseException:
+                cursor.execute('rollback')
+                raise
         finally:
             cursor.close()
+            self._connection.isolation_level = ''
 
-    def update_place(self, place):
+        return result
+
+    def _place_id(self, cursor, key, uri, visit_time):
+        # A new place starts with no visits, they are counted by the
+        # rollup like the visits to existing places.
+        cursor.execute('insert or ignore into places (uri, uri_key, title, '
+                       'bookmark, gecko_flags, visits, last_visit, '
+                       "frecency) values (?, ?, '', 0, 0, 0, ?, null)",
+                       (uri, key, visit_time))
+        # Places are suggested with their https uri once a site moved
+        # to https, see _is_https_upgrade().
+        if uri.lower().startswith('https://'):
+            cursor.execute("update places set uri=? where uri_key=? and "
+                           "uri like 'http://%'", (uri, key))
+        cursor.execute('select rowid from places where uri_key=?', (key,))
+        return cursor.fetchone()[0]
+
+    def _log_visits(self, cursor, log):
+        # Ids are shared by all the partitions, and never reused, so
+        # that the rollup knows which visits it has added.
+        visit_id = self._get_meta(cursor, 'visit_id', 0)
+        partitions = {}
+        for place, visit_time, transition in log:
+            visit_id += 1
+            partitions.setdefault(_partition(visit_time), []).append(
+                (visit_id, place, visit_time, transition))
+
+        for name, rows in partitions.iteritems():
+            cursor.executemany('insert into %s (id, place, visit_time, '
+                               'transition) values (?, ?, ?, ?)' % name, rows)
+        self._set_meta(cursor, 'visit_id', visit_id)
+
+    def _create_partitions(self, cursor, names):
+        names = [name for name in names if name not in self._partitions]
+        if not names:
+            return 0
+
+        for name in names:
+            cursor.execute('create table if not exists %s ('
+                           'id integer primary key, '
+                           'place integer not null, '
+                           'visit_time integer not null, '
+                           'transition integer not null)' % name)
+            cursor.execute('create index if not exists %s_place '
+                           'on %s (place, visit_time)' % (name, name))
+        self._update_visits_view(cursor)
+        return len(names)
+
+    def _list_partitions(self, cursor):
+        cursor.execute('select name from sqlite_master '
+                       "where type='table' and "
+                       "name glob 'visits_[0-9][0-9][0-9][0-9][0-9][0-9]' "
+                       'order by name')
+        self._partitions = [row[0] for row in cursor.fetchall()]
+
+    def _update_visits_view(self, cursor):
+        """Make the visits view and the trigger deleting the visits of
+        deleted places cover the existing partitions."""
+        self._list_partitions(cursor)
+        cursor.execute('drop view if exists visits')
+        cursor.execute('drop trigger if exists places_visits_ad')
+        if not self._partitions:
+            cursor.execute('create view visits as select 0 as id, '
+                           '0 as place, 0 as visit_time, 0 as transition '
+                           'limit 0')
+            return
+
+        cursor.execute('create view visits as %s' % ' union all '.join(
+            ['select id, place, visit_time, transition from %s' % name
+             for name in self._partitions]))
+        cursor.execute('create trigger places_visits_ad after delete on '
+                       'places begin %s end' % ' '.join(
+                           ['delete from %s where place=old.rowid;' % name
+                            for name in self._partitions]))
+
+    def _rollup(self, cursor, limit=-1):
+        # The visits log is append only, the id of the last visit
+        # rolled up is enough to know which ones are left.
+        last_id = self._get_meta(cursor, 'rollup_visit', 0)
+        cursor.execute('select count(*), max(id) from (select id from visits '
+                       'where id > ? order by id limit ?)', (last_id, limit))
+        count, end_id = cursor.fetchone()
+        if not count:
+            return 0
+
+        cursor.execute('select place, count(*), max(visit_time), '
+                       'frecency_sum(transition, visit_time) from visits '
+                       'where id > ? and id <= ? group by place',
+                       (last_id, end_id))
+        cursor.executemany('update places set '
+                           'visits=coalesce(visits, 0) + ?, '
+                           'last_visit=max(coalesce(last_visit, 0), ?), '
+                           'frecency=frecency_add(frecency, ?) '
+                           'where rowid=?',
+                           [(visits, last_visit, frecency, place)
+                            for place, visits, last_visit, frecency
+                            in cursor.fetchall()])
+        self._set_meta(cursor, 'rollup_visit', end_id)
+        return count
+
+    def maintain(self, budget, idle=True):
+        """Run the maintenance tasks of the database that are due, for
+        about budget seconds.
+
+        Tasks are the incremental vacuum, ANALYZE for the query planner
+        and an integrity check, each one run every few days, see
+        _MAINTENANCE_TASKS.  idle tells whether the user may be waiting
+        for the main loop, then the tasks that can't be interrupted
+        are left for a later call.  The last run of the tasks is stored
+        in the database, so that they are spread over the sessions of
+        every Browse instance.  A task that doesn't end in time is
+        stopped and continued or started again by the next call.
+        Return whether tasks this call could run are left.
+        """
+        self.flush()
+        deadline = time.time() + budget
         cursor = self._connection.cursor()
 
         try:
-            cursor.execute('update places set title=?, gecko_flags=?, '
-                           'visits=?, last_visit=?, bookmark=? where uri=?',
-                           (place.title, place.gecko_flags, place.visits,
-                            place.last_visit, place.bookmark, place.uri))
-            self._connection.commit()
+            for name, days, in_idle in _MAINTENANCE_TASKS:
+                if idle and not in_idle:
+                    continue
+                key = 'maintenance_%s' % name
+                last_run = self._get_meta(cursor, key, 0)
+                if now() - last_run < days * _MS_PER_DAY:
+                    continue
+                if time.time() >= deadline:
+                    return True
+
+                # Statements still running at the deadline are
+                # interrupted.
+                self._connection.set_progress_handler(
+                    lambda: time.time() >= deadline, 1000)
+                start = time.time()
+                try:
+                    done = getattr(self, '_maintain_%s' % name)(deadline)
+                except sqlite3.OperationalError, e:
+                    if 'interrupted' not in str(e) and not _is_busy(e):
+                        raise
+                    done = False
+                finally:
+                    self._connection.set_progress_handler(None, 0)
+
+                logging.debug('Places maintenance %s %s in %.3fs', name,
+                              'done' if done else 'stopped',
+                              time.time() - start)
+                if not done:
+                    return True
+                self._write(self._set_meta, key, now())
         finally:
             cursor.close()
 
-    def _place_from_row(self, row):
-        place = Place()
+        return False
+
+    def _maintain_vacuum(self, deadline):
+        cursor = self._connection.cursor()
+
+        try:
+            cursor.execute('pragma auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                # Databases created before the incremental vacuum need
+                # a full one to enable it.  It rewrites the whole file,
+                # so it is only started when it should fit in time,
+                # and tried again on the next run otherwise.  Free
+                # pages are still reused meanwhile.
+                cursor.execute('pragma page_count')
+                pages = cursor.fetchone()[0]
+                cursor.execute('pragma page_size')
+                size = pages * cursor.fetchone()[0]
+                if size > (deadline - time.time()) * _VACUUM_RATE:
+                    logging.debug('Places database too large to enable '
+                                  'the incremental vacuum now')
+                    return True
+                self._connection.commit()
+                cursor.execute('pragma auto_vacuum=incremental')
+                cursor.execute('vacuum')
+                return True
+        finally:
+            cursor.close()
 
-        # Return uri and title as empty strings instead of None.
-        # Previous versions of Browse were allowing to store None for
-        # those fields in the places database.  See ticket #3400 .
-        if row[0] is None:
-            row = tuple([''] + list(row[1:]))
-        if row[1] is None:
-            row = tuple([row[0], ''] + list(row[2:]))
+        while time.time() < deadline:
+            free_pages = self._write(self._incremental_vacuum)
+            if free_pages is None:
+                return False
+            if not free_pages:
+                return True
+        return False
 
-        place.uri, place.title, place.bookmark, place.gecko_flags, \
-            place.visits, place.last_visit = row
+    def _incremental_vacuum(self, cursor):
+        # Return the number of free pages left.
+        cursor.execute('pragma incremental_vacuum(%d)' % _VACUUM_PAGES)
+        cursor.fetchall()
+        cursor.execute('pragma freelist_count')
+        return cursor.fetchone()[0]
 
-        return place
+    def _maintain_analyze(self, deadline):
+        return self._write(self._analyze) is not None
 
-    def _cleanup(self):
+    def _analyze(self, cursor):
+        # Only sample the indexes, ANALYZE of a large history would
+        # otherwise read all of it.
+        cursor.execute('pragma analysis_limit=%d' % _ANALYSIS_LIMIT)
+        cursor.execute('analyze')
+        return True
+
+    def _maintain_quick_check(self, deadline):
+        # Tables are checked one at a time, and the next run resumes
+        # after the last one checked.  The progress handler would only
+        # stop a check once done, wasting it, large tables may take
+        # longer than the time left instead.
+        self._connection.set_progress_handler(None, 0)
         cursor = self._connection.cursor()
 
+        if sqlite3.sqlite_version_info < _QUICK_CHECK_TABLE_VERSION:
+            try:
+                cursor.execute('pragma quick_check')
+                errors = [row[0] for row in cursor.fetchall()]
+                if errors != ['ok']:
+                    logging.error('Places database is corrupted: %s',
+                                  '; '.join(errors))
+            finally:
+                cursor.close()
+            return True
+
         try:
-            date = datetime.now() - timedelta(days=self.EXPIRE_DAYS)
-            cursor.execute('delete from places where last_visit < ?', (date,))
-            self._connection.commit()
+            cursor.execute("select name from sqlite_master "
+                           "where type='table' order by name")
+            tables = [row[0] for row in cursor.fetchall()]
+            last_table = self._get_meta(cursor, 'quick_check_table', '')
+            for table in tables:
+                if table <= last_table:
+                    continue
+                if time.time() >= deadline:
+                    return False
+
+                cursor.execute('pragma quick_check(%s)' % table)
+                errors = [row[0] for row in cursor.fetchall()]
+                if errors != ['ok']:
+                    logging.error('Places table %s is corrupted: %s', table,
+                                  '; '.join(errors))
+                self._write(self._set_meta, 'quick_check_table', table)
+        finally:
+            cursor.close()
+
+        self._write(self._set_meta, 'quick_check_table', '')
+        return True
+
+    def _get_meta(self, cursor, key, default=None):
+        cursor.execute('select value from places_meta where key=?', (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_meta(self, cursor, key, value):
+        cursor.execute('insert or replace into places_meta (key, value) '
+                       'values (?, ?)', (key, value))
+
+    def top_places(self, limit):
+        """Return the limit places with the highest frecency."""
+        self.flush()
+        cursor = _place_cursor(self._connection)
+
+        try:
+            cursor.execute('select %s from places '
+                           'order by frecency desc limit 0, ?' %
+                           _PLACE_COLUMNS, (limit,))
+            return cursor.fetchall()
         finally:
             cursor.close()
 
+    def iter_places(self):
+        """Yield every place, in the order they were added.
+
+        Places are read BULK_BATCH at a time, so that they are never
+        all in memory and other Browse instances can write in between.
+        """
+        self.flush()
+        self.rollup(-1)
+        last_id = 0
+
+        while True:
+            cursor = self._connection.cursor(_KeysetCursor)
+            cursor.row_factory = _keyset_place_factory
+            try:
+                cursor.execute('select %s, rowid from places where rowid > ? '
+                               'order by rowid limit ?' % _PLACE_COLUMNS,
+                               (last_id, self.BULK_BATCH))
+                places = cursor.fetchall()
+                last_id = cursor.last_id
+            finally:
+                cursor.close()
+
+            if not places:
+                return
+            for place in places:
+                yield place
+
+    def import_places(self, places):
+        """Add the places of the iterable places, BULK_BATCH per
+        transaction.
+
+        A place whose canonical_uri() is already in the database, or
+        earlier in places, is merged into it: its visits and frecency
+        are added, and its title is kept if it was visited last.
+        Return the number of places read.
+        """
+        self.flush()
+        self.place_cache.clear()
+        count = 0
+        batch = {}
+
+        for place in places:
+            count += 1
+            key = canonical_uri(place.uri)
+            merged = batch.get(key)
+            if merged is None:
+                batch[key] = [place.title, place.bookmark,
+                              place.gecko_flags, place.visits,
+                              place.last_visit, place.frecency, place.uri]
+            else:
+                if place.title and (place.last_visit >= merged[4] or
+                                    not merged[0]):
+                    merged[0] = place.title
+                merged[1] = merged[1] or place.bookmark
+                merged[3] += place.visits
+                merged[4] = max(merged[4], place.last_visit)
+                merged[5] = frecency_add(merged[5], place.frecency)
+
+            if len(batch) >= self.BULK_BATCH:
+                self._import_batch(batch)
+                batch = {}
+
+        if batch:
+            self._import_batch(batch)
+        return count
+
+    def _import_batch(self, batch):
+        if self._schema_transaction(self._import, batch) is None:
+            raise sqlite3.OperationalError('places database is locked, '
+                                           'import stopped')
+
+    def _import(self, cursor, batch):
+        # The insert triggers index places one at a time, it is much
+        # faster to index the whole batch at once.  They are dropped
+        # while the transaction runs, so other connections never see
+        # them missing.
+        cursor.execute('select name, sql from sqlite_master '
+                       "where type='trigger' and "
+                       "name in ('places_fts_ai', 'places_trigrams_ai')")
+        triggers = dict(cursor.fetchall())
+        for name in triggers:
+            cursor.execute('drop trigger %s' % name)
+        cursor.execute('select coalesce(max(rowid), 0) from places')
+        last_id = cursor.fetchone()[0]
+
+        # Existing places are updated, then the others inserted.  The
+        # title is only set when it changes, not to reindex it.
+        cursor.executemany('update places set title=? where uri_key=? and '
+                           'title is not ? and '
+                           "(coalesce(title, '') = '' or last_visit <= ?)",
+                           [(title, key, title, last_visit)
+                            for key, (title, bookmark_, gecko_flags_, visits_,
+                                      last_visit, frecency_, uri_)
+                            in batch.iteritems() if title])
+        cursor.executemany('update places set '
+                           'bookmark=max(coalesce(bookmark, 0), ?), '
+                           'visits=coalesce(visits, 0) + ?, '
+                           'last_visit=max(coalesce(last_visit, 0), ?), '
+                           'frecency=frecency_add(frecency, ?) '
+                           'where uri_key=?',
+                           [(bookmark, visits, last_visit, frecency, key)
+                            for key, (title_, bookmark, gecko_flags_, visits,
+                                      last_visit, frecency, uri_)
+                            in batch.iteritems()])
+        cursor.executemany('insert or ignore into places (uri, uri_key, '
+                           'title, bookmark, gecko_flags, visits, '
+                           'last_visit, frecency) '
+                           'values (?, ?, ?, ?, ?, ?, ?, ?)',
+                           [(row[6], key) + tuple(row[:6])
+                            for key, row in batch.iteritems()])
+
+        # New places are left in the trigram queue, for GlobalHistory
+        # to index them in the background.
+        if 'places_fts_ai' in triggers:
+            cursor.execute('insert into places_fts(docid, uri, title) '
+                           'select rowid, uri, title from places '
+                           'where rowid > ?', (last_id,))
+        if 'places_trigrams_ai' in triggers:
+            cursor.execute('insert or ignore into places_trigram_queue '
+                           'select rowid from places where rowid > ?',
+                           (last_id,))
+        for sql in triggers.itervalues():
+            cursor.execute(sql)
+        return len(batch)
+
+    def prune(self, limit):
+        """Delete up to limit places that were not visited in the last
+        EXPIRE_DAYS days, and the partitions of the visits log that
+        only have expired visits.
+
+        Return the number of places deleted, if it is less than limit
+        there is nothing left to prune or the database is busy.
+        """
+        date = now() - self.EXPIRE_DAYS * _MS_PER_DAY
+        count = self._write(self._prune, date, limit)
+        if count is None:
+            return 0
+        if count:
+            self.place_cache.clear()
+
+        for name in self._partitions:
+            if _partition_range(name)[1] <= date:
+                self._schema_transaction(self._drop_partitions, date)
+                break
+        return count
+
+    def _prune(self, cursor, date, limit):
+        # The last visit of places must be up to date, not to delete
+        # places that were visited again, and the visits of dropped
+        # partitions must be counted.
+        self._rollup(cursor)
+        cursor.execute('delete from places where rowid in '
+                       '(select rowid from places where last_visit < ? '
+                       'limit ?)', (date, limit))
+        return cursor.rowcount
+
+    def _drop_partitions(self, cursor, date):
+        # Another Browse instance may have dropped them already.
+        self._list_partitions(cursor)
+        for name in self._partitions:
+            if _partition_range(name)[1] <= date:
+                cursor.execute('drop table %s' % name)
+        self._update_visits_view(cursor)
+
+    def _migrate_schema(self):
+        # Another Browse instance may be migrating the same database,
+        # each attempt waits up to _BUSY_TIMEOUT for its lock.
+        # _migrate() reads the version again once it holds the lock,
+        # so nothing is left to do when the other instance is done.
+        deadline = time.time() + _MIGRATION_TIMEOUT
+        while self._schema_transaction(self._migrate) is None:
+            if time.time() >= deadline:
+                raise sqlite3.OperationalError('places database is '
+                                               'locked, it could not be '
+                                               'migrated')
+
+    def _migrate(self, cursor):
+        # Run in a single transaction, so that other Browse instances
+        # wait for the migration to end.
+        cursor.execute('pragma user_version')
+        version = cursor.fetchone()[0]
+        while version < SCHEMA_VERSION:
+            version += 1
+            logging.debug('Migrating places database to version %d',
+                          version)
+            getattr(self, '_migrate_to_%d' % version)(cursor)
+            cursor.execute('pragma user_version = %d' % version)
+        return version
+
+    def _migrate_to_1(self, cursor):
+        # Full-text index over uri and title, so that search doesn't
+        # need to scan the whole places table.  The index doesn't
+        # store a copy of the text, it reads it back from places.
+        # Triggers only fire when uri or title change, so recording
+        # a visit doesn't touch the index.
+        try:
+            cursor.execute('create virtual table if not exists places_fts '
+                           'using fts4(content="places", uri, title)')
+        except sqlite3.OperationalError:
+            logging.warning('SQLite has no FTS4 support, search in places '
+                            'will not be indexed')
+            return
+
+        cursor.execute('create trigger if not exists places_fts_bu '
+                       'before update of uri, title on places begin '
+                       'delete from places_fts where docid=old.rowid; end')
+        cursor.execute('create trigger if not exists places_fts_bd '
+                       'before delete on places begin '
+                       'delete from places_fts where docid=old.rowid; end')
+        cursor.execute('create trigger if not exists places_fts_au '
+                       'after update of uri, title on places begin '
+                       'insert into places_fts(docid, uri, title) '
+                       'values (new.rowid, new.uri, new.title); end')
+        cursor.execute('create trigger if not exists places_fts_ai '
+                       'after insert on places begin '
+                       'insert into places_fts(docid, uri, title) '
+                       'values (new.rowid, new.uri, new.title); end')
+        cursor.execute("insert into places_fts(places_fts) values ('rebuild')")
+
+    def _migrate_to_2(self, cursor):
+        # Older versions could store the same uri more than once.
+        # Merge those rows into the oldest one before making uri
+        # unique.
+        cursor.execute('create temp table places_merged as '
+                       'select min(rowid) as id, sum(visits) as visits, '
+                       'max(last_visit) as last_visit, '
+                       'max(bookmark) as bookmark, max(title) as title '
+                       'from places where uri is not null '
+                       'group by uri having count(*) > 1')
+        cursor.execute('update places set '
+                       'visits=(select visits from places_merged '
+                       'where id=places.rowid), '
+                       'last_visit=(select last_visit from places_merged '
+                       'where id=places.rowid), '
+                       'bookmark=(select bookmark from places_merged '
+                       'where id=places.rowid), '
+                       "title=coalesce(nullif(title, ''), "
+                       '(select title from places_merged '
+                       'where id=places.rowid)) '
+                       'where rowid in (select id from places_merged)')
+        cursor.execute('delete from places where uri is not null and '
+                       'rowid not in (select min(rowid) from places '
+                       'group by uri)')
+        cursor.execute('drop table places_merged')
+        cursor.execute('create unique index if not exists places_uri '
+                       'on places (uri)')
+
+    def _migrate_to_3(self, cursor):
+        # Lets prune() find expired places without a full scan.
+        cursor.execute('create index if not exists places_last_visit '
+                       'on places (last_visit)')
+
+    def _migrate_to_4(self, cursor):
+        # last_visit used to be stored as the text of a local time
+        # datetime, convert it to milliseconds since the epoch.
+        cursor.execute("update places set last_visit=coalesce("
+                       "cast(round((julianday(last_visit, 'utc') - "
+                       "2440587.5) * 86400000) as integer), 0) "
+                       "where typeof(last_visit) != 'integer'")
+
+    def _migrate_to_5(self, cursor):
+        # Rank search results by frecency, see frecency_visit().  The
+        # visits of existing places are all counted at their last
+        # visit.
+        cursor.execute('alter table places add column frecency real')
+        cursor.execute('update places set frecency=frecency_visit('
+                       'max(visits, 1), last_visit)')
+        cursor.execute('create index if not exists places_frecency '
+                       'on places (frecency)')
+
+    def _migrate_to_6(self, cursor):
+        # Trigram index of the uris, for searching text in the middle
+        # of them.  The trigrams are computed in Python, so triggers
+        # only queue the places to index, see _index_trigrams().  All
+        # existing places are queued and indexed in the background.
+        try:
+            cursor.execute('create table if not exists places_trigrams ('
+                           'trigram text, place integer, '
+                           'primary key (trigram, place)) without rowid')
+        except sqlite3.OperationalError:
+            logging.warning('SQLite is too old for the trigram index, '
+                            'search in uris will not be indexed')
+            return
+
+        cursor.execute('create index if not exists places_trigrams_place '
+                       'on places_trigrams (place)')
+        cursor.execute('create table if not exists places_trigram_queue ('
+                       'place integer primary key)')
+        cursor.execute('create trigger if not exists places_trigrams_ai '
+                       'after insert on places begin '
+                       'insert or ignore into places_trigram_queue '
+                       'values (new.rowid); end')
+        cursor.execute('create trigger if not exists places_trigrams_au '
+                       'after update of uri on places begin '
+                       'insert or ignore into places_trigram_queue '
+                       'values (new.rowid); end')
+        cursor.execute('create trigger if not exists places_trigrams_ad '
+                       'after delete on places begin '
+                       'delete from places_trigrams where place=old.rowid; '
+                       'delete from places_trigram_queue '
+                       'where place=old.rowid; end')
+        cursor.execute('insert or ignore into places_trigram_queue '
+                       'select rowid from places')
+
+    def _migrate_to_7(self, cursor):
+        # Log of every visit, so that visits in a period can be
+        # counted and a visit is an insert rather than an update of
+        # its place.  rollup() adds the logged visits to the places in
+        # batches, and remembers the last one it added in places_meta.
+        # Ids are never reused, so that deleting the last visits
+        # can't hide new ones from the rollup.
+        cursor.execute('create table if not exists visits ('
+                       'id integer primary key autoincrement, '
+                       'place integer not null, '
+                       'visit_time integer not null, '
+                       'transition integer not null)')
+        cursor.execute('create index if not exists visits_visit_time '
+                       'on visits (visit_time)')
+        cursor.execute('create index if not exists visits_place '
+                       'on visits (place, visit_time)')
+        cursor.execute('create table if not exists places_meta ('
+                       'key text primary key, value)')
+        cursor.execute('create trigger if not exists places_visits_ad '
+                       'after delete on places begin '
+                       'delete from visits where place=old.rowid; end')
+
+    def _migrate_to_8(self, cursor):
+        # Store the visits log in a table per month, so that expired
+        # visits are dropped with their table rather than deleted one
+        # by one.  They are read through the visits view, see
+        # _update_visits_view().
+        cursor.execute('alter table visits rename to visits_log')
+        cursor.execute('drop trigger if exists places_visits_ad')
+        cursor.execute('select distinct visit_time / ? from visits_log',
+                       (_MS_PER_DAY,))
+        names = set([_partition(day * _MS_PER_DAY)
+                     for day, in cursor.fetchall()])
+        self._create_partitions(cursor, names)
+        for name in names:
+            cursor.execute('insert or ignore into %s select id, place, '
+                           'visit_time, transition from visits_log '
+                           'where visit_time >= ? and visit_time < ?' % name,
+                           _partition_range(name))
+
+        # The last ids may have been pruned, new visits must still get
+        # higher ones.  The sequence was renamed along with its table.
+        cursor.execute('select max(id) from visits_log')
+        visit_id = max(cursor.fetchone()[0] or 0,
+                       int(self._get_meta(cursor, 'rollup_visit', 0)))
+        cursor.execute('select seq from sqlite_sequence '
+                       "where name='visits_log'")
+        row = cursor.fetchone()
+        if row is not None:
+            visit_id = max(visit_id, row[0])
+        self._set_meta(cursor, 'visit_id', visit_id)
+        cursor.execute('drop table visits_log')
+        if not names:
+            self._update_visits_view(cursor)
+
+    def _migrate_to_9(self, cursor):
+        # Places are stored once per page, by the canonical_uri() of
+        # their uri, and keep the uri of the oldest one, or its https
+        # version.  Merge the places of the same page into the oldest
+        # one, and move their visits to it.
+        cursor.execute('alter table places add column uri_key text')
+        cursor.execute('update places set uri_key=canonical_uri(uri)')
+        cursor.execute('create index places_key on places (uri_key)')
+        cursor.execute('select uri_key, rowid, uri, title, bookmark, visits, '
+                       'last_visit, frecency from places where uri_key in '
+                       '(select uri_key from places group by uri_key '
+                       'having count(*) > 1) order by uri_key, rowid')
+        merged = []
+        moved = []
+        for key_, rows in itertools.groupby(cursor.fetchall(),
+                                            lambda row: row[0]):
+            rows = list(rows)
+            place = rows[0][1]
+            uri = rows[0][2]
+            title = rows[0][3]
+            last_title_visit = None
+            bookmark, visits, last_visit, frecency = 0, 0, 0, None
+            for key_, rowid, row_uri, row_title, row_bookmark, row_visits, \
+                    row_last_visit, row_frecency in rows:
+                if _is_https_upgrade(uri, row_uri):
+                    uri = row_uri
+                if row_title and (last_title_visit is None or
+                                  row_last_visit >= last_title_visit):
+                    title = row_title
+                    last_title_visit = row_last_visit
+                bookmark = max(bookmark, row_bookmark or 0)
+                visits += row_visits or 0
+                last_visit = max(last_visit, row_last_visit or 0)
+                frecency = frecency_add(frecency, row_frecency)
+                if rowid != place:
+                    moved.append((place, rowid))
+            merged.append((uri, title, bookmark, visits, last_visit,
+                           frecency, place))
+
+        self._list_partitions(cursor)
+        for name in self._partitions:
+            cursor.executemany('update %s set place=? where place=?' % name,
+                               moved)
+        # Deleted first, their uri can be the one kept.
+        cursor.executemany('delete from places where rowid=?',
+                           [(rowid,) for place_, rowid in moved])
+        cursor.executemany('update places set uri=?, title=?, bookmark=?, '
+                           'visits=?, last_visit=?, frecency=? '
+                           'where rowid=?', merged)
+
+        cursor.execute('drop index places_key')
+        cursor.execute('drop index if exists places_uri')
+        cursor.execute('create unique index places_key on places (uri_key)')
+
+
+class MemoryStore(SqliteStore):
+    """Places kept in memory, for sessions that don't keep their
+    history, like guest sessions.
+
+    The database has the schema of a SqliteStore and is used the same
+    way, but nothing is written to disk unless save() is called with a
+    snapshot_path, and the places are lost on close().  Other Browse
+    instances don't see them.
+    """
+
+    _names = itertools.count()
+
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        # The connections of create_searcher() share the database
+        # through the URI of its cache.
+        uri = 'file:places-%d?mode=memory&cache=shared' % next(self._names)
+        SqliteStore.__init__(self, uri)
+
+    def _connect(self):
+        connection = SqliteStore._connect(self)
+        cursor = connection.execute('pragma database_list')
+        if cursor.fetchone()[2]:
+            # SQLite was built without URI filenames, it opened a file
+            # named like the URI.
+            connection.close()
+            os.remove(self._db_path)
+            raise sqlite3.NotSupportedError('SQLite can not share an '
+                                            'in-memory database')
+
+        # Connections sharing a cache lock tables instead of waiting
+        # for each other, searches read without the locks.
+        connection.execute('pragma read_uncommitted=1')
+        return connection
+
+    def _set_journal_mode(self):
+        # The journal is already in memory.
+        pass
+
+    def save(self):
+        """Write a copy of the places to snapshot_path, if it is set.
+
+        The copy is a places database that a SqliteStore can open.  It
+        replaces the previous one at once, so that it is never left
+        half written.
+        """
+        self.flush()
+        if self.snapshot_path is None:
+            return
+
+        temp_path = self.snapshot_path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            self._connection.execute('vacuum into ?', (temp_path,))
+        except sqlite3.OperationalError, e:
+            # SQLite older than 3.27 can't vacuum into another file.
+            logging.debug('Places snapshot dumped, no vacuum into: %s', e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._dump(temp_path)
+        os.rename(temp_path, self.snapshot_path)
+
+    def _dump(self, path):
+        """Write a copy of the places to a new places database at
+        path, through the connection of a SqliteStore."""
+        target = SqliteStore(path)
+        connection = target._connection
+        connection.execute('attach database ? as source', (self._db_path,))
+        try:
+            target._schema_transaction(target._create_partitions,
+                                       set(self._partitions))
+            target._write(self._copy_to, target)
+        finally:
+            connection.execute('detach database source')
+            target.close()
+
+    def _copy_to(self, cursor, target):
+        # The full-text index is filled by the triggers of places.
+        cursor.execute('insert into places (rowid, uri, uri_key, title, '
+                       'bookmark, gecko_flags, visits, last_visit, '
+                       'frecency) select rowid, uri, uri_key, title, '
+                       'bookmark, gecko_flags, visits, last_visit, '
+                       'frecency from source.places')
+        if target._searcher.has_trigrams:
+            cursor.execute('delete from places_trigram_queue')
+            cursor.execute('insert into places_trigrams '
+                           'select * from source.places_trigrams')
+            cursor.execute('insert into places_trigram_queue '
+                           'select * from source.places_trigram_queue')
+        for name in self._partitions:
+            cursor.execute('insert into %s select * from source.%s' %
+                           (name, name))
+        cursor.execute('insert or replace into places_meta '
+                       'select * from source.places_meta')
+
+
+# Stores get_store() can create, by name, see set_backend().
+BACKENDS = {'sqlite': SqliteStore,
+            'memory': MemoryStore}
+_backend = ('sqlite', ())
+
+
+def set_backend(name, *args):
+    """Make get_store() create a store of BACKENDS[name], given args.
+
+    It must be called before the store is first used.
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown places backend %r' % name)
+    if _store is not None:
+        raise RuntimeError('Places store already created')
+    _backend = (name, args)
+
 
 def get_store():
     global _store
     if _store is None:
-        _store = SqliteStore()
+        name, args = _backend
+        try:
+            _store = BACKENDS[name](*args)
+        except sqlite3.NotSupportedError, e:
+            logging.warning('Places %s backend not available, history '
+                            'is stored on disk: %s', name, e)
+            _store = SqliteStore()
     return _store
@@ -0,0 +1,617 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Benchmarks of the places database and the global history, run
+without Sugar or WebKit:
+
+    python placesbench.py --sizes 1000,10000 --output results.json
+
+For each size a synthetic history is created and the operations of
+the URL entry and of page loads are timed.  The results are printed
+and, with --output, written as JSON so that runs can be compared.
+
+With --stress, several processes use the same database at once as
+Browse instances do, and the visits they recorded are checked.
+
+With another --backend than sqlite, the store is first checked to
+give the same results as a SqliteStore, and nothing is timed if it
+doesn't.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import globalhistory
+import places
+from urltrie import UrlTrie
+
+_CONSONANTS = 'bcdfghjklmnprstvz'
+_VOWELS = 'aeiou'
+_TLDS = ['org', 'com', 'net', 'edu', 'org.uy', 'com.pe']
+_SCHEMES = ['http', 'http', 'https']
+
+# The search places used before the full-text and trigram indexes.
+_LIKE_QUERY = ('select uri, title, bookmark, gecko_flags, visits, '
+               'last_visit, frecency from places '
+               'where uri like ? or title like ? '
+               'order by visits desc limit 0, ?')
+
+# Part of the history older than EXPIRE_DAYS, for prune().
+_EXPIRED_RATIO = 0.3
+
+# Pages loaded between flushes of the history.
+_PAGES_PER_FLUSH = 20
+
+# Bound the calls timed for operations that would otherwise run for
+# minutes on the largest histories.
+_MAX_PRUNE_CALLS = 200
+
+# Searches compared by check_backend().
+_CHECK_QUERIES = [u'ka', u'www', u'title 1', u'zu', u'org/ba', u'http']
+
+
+def _zipf(rand, items):
+    """Return an item of items, the first ones being much more likely
+    than the last ones, as with hosts and words."""
+    return items[int(len(items) ** rand.random()) - 1]
+
+
+def _words(rand, count):
+    return [''.join([rand.choice(_CONSONANTS) + rand.choice(_VOWELS)
+                     for j in range(rand.randint(2, 4))])
+            for i in range(count)]
+
+
+def generate_places(count, seed=0):
+    """Yield count (uri, title, visits, last_visit) tuples of a
+    synthetic history.
+
+    Hosts and words follow a Zipf like distribution, so a few sites
+    hold most of the places and some words are in many titles, and
+    visits are spread over the expiry period and a bit before it.
+    """
+    rand = random.Random(seed)
+    words = _words(rand, 5000)
+    hosts = ['www.%s.%s' % (word, rand.choice(_TLDS))
+             for word in _words(rand, max(count / 20, 1))]
+    period = places.SqliteStore.EXPIRE_DAYS * 24 * 3600000
+    end = places.now()
+    start = end - int(period / (1 - _EXPIRED_RATIO))
+    for i in xrange(count):
+        host = _zipf(rand, hosts)
+        path = '/'.join([_zipf(rand, words)
+                         for j in range(rand.randint(1, 3))])
+        uri = '%s://%s/%s/%d' % (rand.choice(_SCHEMES), host, path, i)
+        if rand.random() < 0.2:
+            uri += '?%s=%d' % (_zipf(rand, words), rand.randint(1, 1000))
+        title = ' '.join([_zipf(rand, words).title()
+                          for j in range(rand.randint(1, 6))])
+        if rand.random() < 0.5:
+            title += ' - ' + host.split('.')[1].title()
+        yield (uri, title, int(1 / (rand.random() + 0.02)) + 1,
+               rand.randint(start, end))
+
+
+def create_store(db_path, count, seed=0):
+    """Create a places database with count synthetic places, and the
+    last visit of each one in the visits log."""
+    store = places.SqliteStore(db_path)
+    cursor = store._connection.cursor()
+    cursor.executemany('insert into places (uri, uri_key, title, bookmark, '
+                       'gecko_flags, visits, last_visit, frecency) '
+                       'values (?, canonical_uri(?), ?, 0, 0, ?, ?, '
+                       'frecency_visit(?, ?))',
+                       ((uri, uri, title, visits, last_visit, visits,
+                         last_visit)
+                        for uri, title, visits, last_visit
+                        in generate_places(count, seed)))
+    store._connection.commit()
+
+    cursor.execute('select rowid, last_visit from places')
+    log = [(place, last_visit, places.TRANSITION_LINK)
+           for place, last_visit in cursor.fetchall()]
+    store._create_partitions(cursor, set(
+        [places._partition(visit_time) for place_, visit_time, t_ in log]))
+    store._log_visits(cursor, log)
+    # The visits are already counted in places.
+    store._set_meta(cursor, 'rollup_visit', len(log))
+    store._connection.commit()
+
+    store.index_trigrams(-1)
+    store.close()
+
+
+def _sample_uris(db_path, count, seed=0):
+    rand = random.Random(seed)
+    connection = sqlite3.connect(db_path)
+    try:
+        cursor = connection.execute('select uri, title from places '
+                                    'order by random() limit ?', (count,))
+        rows = cursor.fetchall()
+    finally:
+        connection.close()
+    rand.shuffle(rows)
+    return rows
+
+
+def fragments(rows, seed=0):
+    """Return pieces of text from the middle of the uris of rows."""
+    rand = random.Random(seed)
+    result = []
+    for uri, title_ in rows:
+        path = uri.partition('://www.')[2]
+        length = rand.randint(5, 8)
+        start = rand.randint(0, max(len(path) - length, 0))
+        result.append(path[start:start + length])
+    return result
+
+
+def typed_words(rows, seed=0):
+    """Return the start of words of the titles of rows, as typed to
+    find a page by its title."""
+    rand = random.Random(seed)
+    result = []
+    for uri_, title in rows:
+        words = title.split()
+        text = rand.choice(words)[:rand.randint(2, 5)]
+        if len(words) > 1 and rand.random() < 0.3:
+            text = rand.choice(words)[:4] + ' ' + text
+        result.append(text.lower())
+    return result
+
+
+def time_calls(function, args_list):
+    """Return the statistics of the time of function(*args) over
+    args_list, in milliseconds."""
+    times = []
+    for args in args_list:
+        start = time.time()
+        function(*args)
+        times.append((time.time() - start) * 1000)
+    return _stats(times)
+
+
+def _stats(times):
+    times = sorted(times)
+    return {'calls': len(times),
+            'median_ms': times[len(times) / 2],
+            'p90_ms': times[len(times) * 9 / 10],
+            'max_ms': times[-1]}
+
+
+def bench_open(db_path, calls):
+    def open_store():
+        store = places.SqliteStore(db_path)
+        store.close()
+
+    def load_trie():
+        store = places.SqliteStore(db_path)
+        UrlTrie().load(store, globalhistory._TRIE_PLACES)
+        store.close()
+
+    return {'open': time_calls(open_store, [()] * calls),
+            'open_load_trie': time_calls(load_trie, [()] * calls)}
+
+
+def bench_search(store, rows):
+    limit = places.SqliteStore.MAX_SEARCH_MATCHES
+    cursor = store._connection.cursor()
+
+    def like_search(text):
+        like = '%' + text + '%'
+        cursor.execute(_LIKE_QUERY, (like, like, limit))
+        cursor.fetchall()
+
+    substrings = [(text,) for text in fragments(rows)]
+    words = [(text,) for text in typed_words(rows)]
+    return {'search_like': time_calls(like_search, substrings),
+            'search_substring': time_calls(store.search, substrings),
+            'search_words': time_calls(store.search, words)}
+
+
+def bench_history(store, rows, seed=0):
+    """Time page loads through GlobalHistory: a visit and a title per
+    page, half of them new, flushed every _PAGES_PER_FLUSH pages."""
+    rand = random.Random(seed)
+    history = globalhistory.GlobalHistory(store)
+    add_page = []
+    set_page_title = []
+    flush = []
+
+    for i, (uri, title) in enumerate(rows):
+        if rand.random() < 0.5:
+            uri = '%s/new/%d' % (uri, i)
+
+        start = time.time()
+        history.add_page(uri)
+        add_page.append((time.time() - start) * 1000)
+
+        start = time.time()
+        history.set_page_title(uri, title)
+        set_page_title.append((time.time() - start) * 1000)
+
+        if i % _PAGES_PER_FLUSH == _PAGES_PER_FLUSH - 1:
+            start = time.time()
+            history.flush()
+            flush.append((time.time() - start) * 1000)
+
+    start = time.time()
+    history.flush()
+    flush.append((time.time() - start) * 1000)
+    result = {'add_page': _stats(add_page),
+              'set_page_title': _stats(set_page_title),
+              'flush': _stats(flush)}
+
+    calls = []
+    while True:
+        start = time.time()
+        count = store.rollup(globalhistory._ROLLUP_BATCH)
+        calls.append((time.time() - start) * 1000)
+        if count < globalhistory._ROLLUP_BATCH:
+            break
+    result['rollup'] = _stats(calls)
+    return result
+
+
+def bench_lookup(store, rows):
+    """Time lookup_place() as done around a page load, three times per
+    uri with a visit in between."""
+    calls = []
+    for uri, title_ in rows:
+        for i in range(3):
+            start = time.time()
+            store.lookup_place(uri)
+            calls.append((time.time() - start) * 1000)
+            if i == 0:
+                store.add_visit(uri)
+    store.flush()
+    return {'lookup_place': _stats(calls)}
+
+
+def bench_read(store):
+    """Time reading every place, and measure the size of a Place
+    without its strings."""
+    def read_all():
+        for place_ in store.iter_places():
+            pass
+
+    place = places.Place()
+    size = sys.getsizeof(place)
+    if hasattr(place, '__dict__'):
+        size += sys.getsizeof(place.__dict__)
+    return {'iter_places': time_calls(read_all, [()] * 3)}, size
+
+
+def bench_prune(store):
+    calls = []
+    while len(calls) < _MAX_PRUNE_CALLS:
+        start = time.time()
+        count = store.prune(globalhistory._PRUNE_BATCH)
+        calls.append((time.time() - start) * 1000)
+        if count < globalhistory._PRUNE_BATCH:
+            break
+    return {'prune': _stats(calls)}
+
+
+def bench_maintain(store):
+    """Time the idle maintenance runs, after prune() freed pages, until
+    they are done, then the one when the activity closes."""
+    calls = []
+    more = True
+    while more:
+        start = time.time()
+        more = store.maintain(globalhistory._MAINTENANCE_BUDGET)
+        calls.append((time.time() - start) * 1000)
+
+    start = time.time()
+    store.maintain(globalhistory._SAVE_MAINTENANCE_BUDGET, idle=False)
+    return {'maintain': _stats(calls),
+            'maintain_closing': _stats([(time.time() - start) * 1000])}
+
+
+def open_memory_store(db_path):
+    """Return a MemoryStore with the places of the database at db_path.
+    Their visits log is not copied."""
+    store = places.MemoryStore()
+    source = places.SqliteStore(db_path)
+    try:
+        store.import_places(source.iter_places())
+    finally:
+        source.close()
+    store.index_trigrams(-1)
+    return store
+
+
+def bench_size(work_dir, size, queries, backend='sqlite'):
+    db_path = os.path.join(work_dir, 'places-%d.db' % size)
+    start = time.time()
+    create_store(db_path, size)
+    result = {'places': size,
+              'create_s': time.time() - start,
+              'db_bytes': os.path.getsize(db_path),
+              'operations': {}}
+    operations = result['operations']
+
+    rows = _sample_uris(db_path, queries)
+    if backend == 'memory':
+        store = open_memory_store(db_path)
+    else:
+        operations.update(bench_open(db_path, 5))
+        store = places.SqliteStore(db_path)
+    try:
+        operations.update(bench_search(store, rows))
+        operations.update(bench_history(store, rows))
+        operations.update(bench_lookup(store, rows))
+        read, result['place_bytes'] = bench_read(store)
+        operations.update(read)
+        result['place_cache'] = {'hits': store.place_cache.hits,
+                                 'misses': store.place_cache.misses}
+        operations.update(bench_prune(store))
+        operations.update(bench_maintain(store))
+    finally:
+        store.close()
+    os.remove(db_path)
+    return result
+
+
+def _backend_results(store, count):
+    """Return the results of the operations of Browse on store, filled
+    with count synthetic places."""
+    rows = list(generate_places(count, seed=4))
+    store.import_places(places.Place(uri) for uri, t_, v_, l_ in rows)
+    rand = random.Random(1)
+    for i in range(count / 5):
+        uri = rand.choice(rows)[0]
+        store.add_visit(uri, rand.random() < 0.1)
+        if i % 7 == 0:
+            store.set_title(uri, u'Title %d' % i)
+    store.flush()
+    store.rollup(-1)
+    store.index_trigrams(-1)
+
+    results = []
+    for text in _CHECK_QUERIES:
+        results.append([(match.uri, match.title, match.visits)
+                        for match in store.search(text)])
+    for uri, title_, visits_, last_visit_ in rows[:50]:
+        place = store.lookup_place(uri)
+        results.append((place.uri, place.visits, place.title,
+                        store.count_visits(uri, 0)))
+    results.append([top.uri for top in store.top_places(20)])
+    results.append(len(list(store.iter_places())))
+
+    # Searches from another thread, as the URL entry does.
+    found = []
+
+    def search():
+        searcher = store.create_searcher()
+        found.append([place.uri for place in searcher.search(u'ka', 10)])
+    thread = threading.Thread(target=search)
+    thread.start()
+    thread.join()
+    results.append(found)
+
+    store.EXPIRE_DAYS = 0
+    results.append(store.prune(100))
+    results.append(store.maintain(5, idle=False))
+    results.append([(kept.uri, kept.visits)
+                    for kept in store.iter_places()])
+    return results
+
+
+def check_backend(backend, count=3000):
+    """Run the same operations on a SqliteStore and on a store of
+    backend, and return the problems found."""
+    work_dir = tempfile.mkdtemp(prefix='placesbench-')
+    clock = [places.now()]
+
+    def fake_now():
+        # Visits at the same time would be ordered differently.
+        clock[0] += 1
+        return clock[0]
+
+    now = places.now
+    places.now = fake_now
+    try:
+        expected_clock = clock[0]
+        store = places.SqliteStore(os.path.join(work_dir, 'places.db'))
+        try:
+            expected = _backend_results(store, count)
+        finally:
+            store.close()
+
+        clock[0] = expected_clock
+        snapshot_path = os.path.join(work_dir, 'snapshot.db')
+        store = places.BACKENDS[backend](snapshot_path)
+        try:
+            results = _backend_results(store, count)
+            store.save()
+        finally:
+            store.close()
+
+        problems = []
+        for i, (result, expected_result) in enumerate(zip(results,
+                                                          expected)):
+            if result != expected_result:
+                problems.append('result %d differs: %r instead of %r' %
+                                (i, result, expected_result))
+
+        if os.path.exists(snapshot_path):
+            store = places.SqliteStore(snapshot_path)
+            try:
+                saved = [(place.uri, place.visits)
+                         for place in store.iter_places()]
+            finally:
+                store.close()
+            if saved != expected[-1]:
+                problems.append('%d places saved instead of %d' %
+                                (len(saved), len(expected[-1])))
+    finally:
+        places.now = now
+        shutil.rmtree(work_dir)
+    return problems
+
+
+def _stress_process(db_path, seed, pages, results):
+    rand = random.Random(seed)
+    error = None
+    try:
+        store = places.SqliteStore(db_path)
+        for i in range(pages):
+            uri = 'http://stress%d.example/%d' % (rand.randint(0, 20),
+                                                  rand.randint(0, 50))
+            store.add_visit(uri, rand.random() < 0.1)
+            store.set_title(uri, 'Page %d of %d' % (i, seed))
+            store.search(u'stress%d' % rand.randint(0, 20))
+            if i % 10 == 9:
+                store.flush()
+            if i % 50 == 49:
+                store.rollup(globalhistory._ROLLUP_BATCH)
+            if i % 100 == 99:
+                store.prune(globalhistory._PRUNE_BATCH)
+        store.close()
+        lost = sum([len(visits) for visits, title_
+                    in store._pending.itervalues()])
+    except Exception, e:
+        error = '%s: %s' % (type(e).__name__, e)
+        lost = None
+    results.put((seed, lost, error))
+
+
+def stress(processes, pages):
+    """Record pages visits from each of processes processes sharing a
+    new database, and return the problems found."""
+    work_dir = tempfile.mkdtemp(prefix='placesbench-')
+    try:
+        db_path = os.path.join(work_dir, 'places.db')
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_stress_process,
+                                           args=(db_path, seed, pages,
+                                                 results))
+                   for seed in range(processes)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+
+        problems = []
+        expected = 0
+        for i in range(processes):
+            seed, lost, error = results.get()
+            if error is not None:
+                problems.append('process %d failed: %s' % (seed, error))
+            elif lost:
+                problems.append('process %d kept %d visits queued' %
+                                (seed, lost))
+            else:
+                expected += pages
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+
+        store = places.SqliteStore(db_path)
+        store.rollup(-1)
+        cursor = store._connection.cursor()
+        cursor.execute('select count(*), count(distinct id) from visits')
+        logged, ids = cursor.fetchone()
+        cursor.execute('select sum(visits) from places')
+        counted = cursor.fetchone()[0]
+        store.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    if not problems:
+        if logged != expected or ids != expected:
+            problems.append('%d visits recorded, %d logged with %d ids' %
+                            (expected, logged, ids))
+        if counted != expected:
+            problems.append('%d visits recorded, %d counted in places' %
+                            (expected, counted))
+    print '%d processes recorded %d visits in %.1fs' % \
+        (processes, expected, elapsed)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated numbers of places')
+    parser.add_argument('--queries', type=int, default=100,
+                        help='searches and page loads timed per size')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--backend', choices=sorted(places.BACKENDS),
+                        default='sqlite', help='places store to time')
+    parser.add_argument('--stress', type=int, metavar='PROCESSES',
+                        help='run the concurrency test instead')
+    parser.add_argument('--pages', type=int, default=500,
+                        help='visits per process of the concurrency test')
+    args = parser.parse_args()
+
+    if args.stress:
+        problems = stress(args.stress, args.pages)
+        for problem in problems:
+            print problem
+        sys.exit(1 if problems else 0)
+
+    if args.backend != 'sqlite':
+        problems = check_backend(args.backend)
+        for problem in problems:
+            print problem
+        if problems:
+            sys.exit(1)
+        print '%s backend gives the same results as sqlite' % args.backend
+
+    results = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'sqlite_version': sqlite3.sqlite_version,
+               'schema_version': places.SCHEMA_VERSION,
+               'backend': args.backend,
+               'sizes': []}
+
+    work_dir = tempfile.mkdtemp(prefix='placesbench-')
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            result = bench_size(work_dir, size, args.queries, args.backend)
+            results['sizes'].append(result)
+
+            print '%d places, created in %.1fs, %d bytes' % \
+                (size, result['create_s'], result['db_bytes'])
+            for name, stats in sorted(result['operations'].items()):
+                print '  %-18s median %8.2fms  p90 %8.2fms  max %8.2fms' % \
+                    (name, stats['median_ms'], stats['p90_ms'],
+                     stats['max_ms'])
+            print '  place cache: %(hits)d hits, %(misses)d misses' % \
+                result['place_cache']
+            print '  %d bytes per Place' % result['place_bytes']
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Export or import the browsing history as line-delimited JSON, one
+place per line:
+
+    python placestool.py export history.jsonl
+    python placestool.py import history.jsonl
+
+A file name of - stands for the standard output or input.  Without
+--db the history of the Browse activity is used, which needs Sugar.
+Imported places are merged with the places already in the history.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import places
+
+# Attributes of Place written for each place.  Only uri is required
+# when importing.
+_FIELDS = ['uri', 'title', 'bookmark', 'gecko_flags', 'visits',
+           'last_visit', 'frecency']
+
+
+def place_to_json(place):
+    # Without options, json uses its C encoder.
+    return json.dumps(dict([(field, getattr(place, field))
+                            for field in _FIELDS]))
+
+
+def place_from_json(line):
+    data = json.loads(line)
+    place = places.Place(data['uri'])
+    place.title = data.get('title') or u''
+    place.bookmark = bool(data.get('bookmark'))
+    place.gecko_flags = data.get('gecko_flags') or 0
+    place.visits = data.get('visits') or 0
+    place.last_visit = data.get('last_visit') or place.last_visit
+    if data.get('frecency') is None:
+        place.frecency = places.frecency_visit(max(place.visits, 1),
+                                               place.last_visit)
+    else:
+        place.frecency = data['frecency']
+    return place
+
+
+def export_places(store, f):
+    """Write every place of store to the file f, and return their
+    number."""
+    count = 0
+    for place in store.iter_places():
+        f.write(place_to_json(place))
+        f.write('\n')
+        count += 1
+    return count
+
+
+def import_places(store, f):
+    """Add the places of the file f to store, and return their
+    number."""
+    return store.import_places(place_from_json(line)
+                               for line in f if line.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file')
+    parser.add_argument('--db', help='places database to use')
+    args = parser.parse_args()
+
+    store = places.SqliteStore(args.db)
+    start = time.time()
+    try:
+        if args.command == 'export':
+            if args.file == '-':
+                count = export_places(store, sys.stdout)
+            else:
+                with open(args.file, 'w') as f:
+                    count = export_places(store, f)
+        else:
+            if args.file == '-':
+                count = import_places(store, sys.stdin)
+            else:
+                with open(args.file) as f:
+                    count = import_places(store, f)
+    finally:
+        store.close()
+
+    sys.stderr.write('%sed %d places in %.1fs\n' %
+                     (args.command.capitalize(), count, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
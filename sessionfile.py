@@ -0,0 +1,107 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Binary container for the Journal entries of Browse.
+
+The file starts with MAGIC, the version of the format and the number
+of sections, followed by a table with the name, offset and length of
+each section, and the sections themselves.  A section is read only
+when it is asked for, so the tabs can be restored before the shared
+links and their thumbnails are decoded.
+"""
+
+import struct
+
+# Not valid JSON or text, so that older entries are told apart.
+MAGIC = '\x89BROWSE\n'
+VERSION = 1
+
+_HEADER = struct.Struct('<HH')
+_ENTRY = struct.Struct('<16sII')
+_BLOB = struct.Struct('<40sI')
+
+
+def is_session(data):
+    """Return whether data is in this format, rather than JSON."""
+    return data.startswith(MAGIC)
+
+
+def pack_sections(sections):
+    """Return the file holding sections, a list of (name, data) pairs
+    written in that order."""
+    offset = len(MAGIC) + _HEADER.size + _ENTRY.size * len(sections)
+    parts = [MAGIC, _HEADER.pack(VERSION, len(sections))]
+    for name, data in sections:
+        parts.append(_ENTRY.pack(name, offset, len(data)))
+        offset += len(data)
+    parts.extend(data for name, data in sections)
+    return ''.join(parts)
+
+
+def pack_blobs(blobs):
+    """Return a section holding blobs, a list of (key, data) pairs with
+    keys of 40 characters."""
+    parts = []
+    for key, data in blobs:
+        parts.append(_BLOB.pack(str(key), len(data)))
+        parts.append(data)
+    return ''.join(parts)
+
+
+def unpack_blobs(section):
+    """Return the blobs of a section written by pack_blobs(), as a
+    dictionary."""
+    blobs = {}
+    offset = 0
+    while offset < len(section):
+        key, length = _BLOB.unpack_from(section, offset)
+        offset += _BLOB.size
+        blobs[key] = section[offset:offset + length]
+        offset += length
+    return blobs
+
+
+class SessionFile(object):
+    """The sections of a file written by pack_sections()."""
+
+    def __init__(self, data):
+        if not is_session(data):
+            raise ValueError('Not a session file')
+        version, count = _HEADER.unpack_from(data, len(MAGIC))
+        if version > VERSION:
+            raise ValueError('Unsupported session file version %d' %
+                             version)
+
+        self._data = data
+        self._sections = {}
+        offset = len(MAGIC) + _HEADER.size
+        for i in range(count):
+            name, start, length = _ENTRY.unpack_from(data, offset)
+            if start + length > len(data):
+                raise ValueError('Truncated session file')
+            self._sections[name.rstrip('\0')] = (start, length)
+            offset += _ENTRY.size
+
+    def __contains__(self, name):
+        return name in self._sections
+
+    def get(self, name):
+        """Return the data of the section name, or None if the file
+        has no such section."""
+        if name not in self._sections:
+            return None
+        start, length = self._sections[name]
+        return self._data[start:start + length]
@@ -0,0 +1,187 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import sqlite3
+import threading
+import time
+
+from gi.repository import GObject
+
+import places
+
+# Seconds without a new query before the latest one is run, so that
+# fast typing doesn't queue a search per keystroke.
+_DEBOUNCE_DELAY = 0.08
+
+# Places fetched per query, the candidates that are narrowed down
+# while the user keeps typing.
+_MAX_CANDIDATES = 100
+
+
+class SuggestionWorker(object):
+    """Search places for the URL entry in a thread.
+
+    The thread has its own connection to the places database, so the
+    GTK main loop never waits for SQLite.  Results are delivered to
+    callback(text, places) from the main loop, and only for the latest
+    query: a query made stale by a newer one is dropped, or interrupted
+    if it is already running.
+
+    The places found are kept as candidates: while the text only
+    grows, the matches are picked from them without querying the
+    database again.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._condition = threading.Condition()
+        self._text = None
+        self._query_time = 0
+        self._serial = 0
+        self._running = False
+        self._searcher = None
+        self._has_fts = True
+        self._thread = None
+
+        self._candidates = None
+        self._candidates_text = None
+        self._candidates_complete = False
+        self._data_version = None
+
+    def query(self, text):
+        # Checked by the callbacks of GlobalHistory, not queried on
+        # every keystroke.
+        version = places.get_store().data_version
+        if version != self._data_version:
+            # Another Browse instance changed the history.
+            self._data_version = version
+            self._candidates = None
+
+        if self._narrow(text):
+            return
+
+        with self._condition:
+            self._serial += 1
+            self._text = text
+            self._query_time = time.time()
+            if self._running:
+                self._searcher.interrupt()
+            self._condition.notify()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def cancel(self):
+        """Drop the queries that haven't been delivered yet, and the
+        candidates."""
+        with self._condition:
+            self._serial += 1
+            self._text = None
+            if self._running:
+                self._searcher.interrupt()
+
+        self._candidates = None
+
+    def _narrow(self, text):
+        """Deliver the matches of text from the candidates, if they
+        are known to include the best ones."""
+        if self._candidates is None or \
+                not text.startswith(self._candidates_text):
+            return False
+        if not places._TOKEN_RE.findall(self._candidates_text):
+            # The candidates only match text as a substring, while
+            # a longer text can also match by its words.
+            return False
+
+        # Every place matching text matches the text of the
+        # candidates, so the matches found in them are the ones with
+        # the highest frecency, unless candidates were left out and
+        # not enough matches remain.
+        candidates = [place for place in self._candidates
+                      if places.matches(place, text, self._has_fts)]
+        if not self._candidates_complete and \
+                len(candidates) < places.SqliteStore.MAX_SEARCH_MATCHES:
+            return False
+
+        with self._condition:
+            self._serial += 1
+            self._text = None
+
+        self._candidates = candidates
+        self._candidates_text = text
+        self._callback(text,
+                       candidates[:places.SqliteStore.MAX_SEARCH_MATCHES])
+        return True
+
+    def _run(self):
+        searcher = places.get_store().create_searcher()
+        self._has_fts = searcher.has_fts
+
+        while True:
+            with self._condition:
+                while True:
+                    if self._text is None:
+                        self._condition.wait()
+                        continue
+                    delay = self._query_time + _DEBOUNCE_DELAY - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+
+                text, serial = self._text, self._serial
+                self._text = None
+                self._searcher = searcher
+                self._running = True
+
+            try:
+                result = searcher.search(text, _MAX_CANDIDATES)
+            except sqlite3.OperationalError, e:
+                logging.debug('Search for %r stopped: %s', text, e)
+                result = None
+
+            with self._condition:
+                self._running = False
+
+            if result is not None:
+                GObject.idle_add(self.__deliver_cb, serial, text, result)
+
+    def __deliver_cb(self, serial, text, result):
+        if serial == self._serial:
+            self._candidates_complete = len(result) < _MAX_CANDIDATES
+            self._candidates = self._add_queued(text, result)
+            self._candidates_text = text
+            self._callback(text, self._candidates[
+                :places.SqliteStore.MAX_SEARCH_MATCHES])
+        return False
+
+    def _add_queued(self, text, result):
+        """Return result with the places matching text among the visits
+        queued in the store, which the thread can't see.  They are not
+        flushed for it, as that could wait for the lock of another
+        Browse instance while the user types."""
+        keys = set([places.canonical_uri(place.uri) for place in result])
+        queued = [place for place in places.get_store().queued_places()
+                  if places.canonical_uri(place.uri) not in keys and
+                  places.matches(place, text, self._has_fts)]
+        if not queued:
+            return result
+
+        result = result + queued
+        result.sort(key=lambda place: place.frecency, reverse=True)
+        return result
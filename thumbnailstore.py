@@ -0,0 +1,103 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+import os
+import re
+import time
+from hashlib import sha1
+
+_KEY_RE = re.compile('^[0-9a-f]{40}$')
+
+
+class ThumbnailStore(object):
+    """PNG thumbnails of the shared links, in the files of a directory
+    named by the SHA-1 of their content.
+
+    A thumbnail is stored once however many links or Journal entries
+    use it, and is read only when a link is shown.  The entries carry
+    their thumbnails too, the store is a cache that sweep() keeps
+    small.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def put(self, data):
+        """Store data and return its key."""
+        key = sha1(data).hexdigest()
+        path = os.path.join(self._directory, key)
+        if os.path.exists(path):
+            return key
+
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+        # Written under another name first, so that a thumbnail is
+        # never read half written.
+        temp_path = path + '.tmp'
+        f = open(temp_path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+        return key
+
+    def get(self, key):
+        """Return the data stored with key, or None if it is not in
+        the store, like the thumbnails of entries from other
+        computers."""
+        # Keys come from Journal entries, they must not be paths.
+        if not _KEY_RE.match(key):
+            logging.warning('Invalid thumbnail key %r', key)
+            return None
+
+        try:
+            f = open(os.path.join(self._directory, key), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def sweep(self, keep, max_age):
+        """Remove the thumbnails that are not in keep and were stored
+        more than max_age seconds ago, and return their number.
+
+        Other Journal entries store their thumbnails again when they
+        are resumed, max_age spares those of the entries open in
+        other Browse instances.
+        """
+        try:
+            names = os.listdir(self._directory)
+        except OSError:
+            return 0
+
+        keep = set(keep)
+        horizon = time.time() - max_age
+        removed = 0
+        for name in names:
+            if name in keep:
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                if os.path.getmtime(path) < horizon:
+                    os.remove(path)
+                    removed += 1
+            except OSError, e:
+                logging.warning('Thumbnail %s not removed: %s', name, e)
+        return removed
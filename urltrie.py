@@ -0,0 +1,257 @@
+# Copyright (C) 2013, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import places
+
+# Only this many hosts, the most visited ones, are kept in the trie.
+MAX_HOSTS = 200
+# Completions kept per host, for the host itself and its paths.
+MAX_KEYS_PER_HOST = 32
+# Path segments of a uri that are offered as completions.
+MAX_PATH_DEPTH = 3
+
+_SCHEMES = ('http://', 'https://')
+
+# Nodes are lists rather than objects, to keep them small.  Each one
+# holds the label of the edge that leads to it, its children by the
+# first character of their label (None for leaves), the weight of the
+# completion ending at the node (None if there is none) and the best
+# completion below it, with its weight.
+_LABEL, _CHILDREN, _WEIGHT, _BEST_WEIGHT, _BEST = range(5)
+
+
+def _new_node(label):
+    return [label, None, None, None, None]
+
+
+def strip_uri(text):
+    """Return text without the scheme and www. prefix, with the host
+    in lower case, as completions are stored."""
+    for scheme in _SCHEMES:
+        if text.startswith(scheme):
+            text = text[len(scheme):]
+            break
+
+    host, slash, path = text.partition('/')
+    host = host.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return host + slash + path
+
+
+def uri_completions(uri):
+    """Return the host of uri and the completions it offers: the host,
+    the host without its leading labels, and the host with the first
+    segments of the path.  Return None and no completions for uris
+    that are not web pages.
+    """
+    if not uri.startswith(_SCHEMES):
+        return None, []
+    if isinstance(uri, str):
+        uri = uri.decode('utf-8', 'replace')
+
+    uri = strip_uri(uri)
+    for separator in '?#':
+        uri = uri.partition(separator)[0]
+
+    segments = uri.split('/')
+    host = segments[0]
+    if not host:
+        return None, []
+
+    keys = [host]
+    labels = host.split('.')
+    if not labels[-1].isdigit():
+        for i in range(1, len(labels) - 1):
+            keys.append('.'.join(labels[i:]))
+
+    key = host
+    for segment in segments[1:MAX_PATH_DEPTH + 1]:
+        if not segment:
+            break
+        key = key + '/' + segment
+        keys.append(key)
+
+    return host, keys
+
+
+class UrlTrie(object):
+    """Radix tree of the hosts and paths of visited places, to
+    complete what the user types in the URL entry.
+
+    Every node knows the completion with the highest frecency below
+    it, so complete() only walks down the typed text.
+    """
+
+    def __init__(self):
+        self._root = _new_node('')
+        # Visits and completions of each host in the trie.
+        self._hosts = {}
+        # Number of hosts offering each completion, as hosts share
+        # their suffixes.
+        self._key_hosts = {}
+
+    def load(self, store, limit):
+        """Add the limit places with the highest frecency in store."""
+        for place in store.top_places(limit):
+            self.add(place.uri, place.frecency, max(place.visits, 1))
+
+    def add_visit(self, uri, typed=False):
+        if typed:
+            weight = places.TYPED_VISIT_WEIGHT
+        else:
+            weight = places.VISIT_WEIGHT
+        self.add(uri, places.frecency_visit(weight, places.now()), 1)
+
+    def add(self, uri, frecency, visits):
+        """Add the frecency and visits of uri to its completions."""
+        host, keys = uri_completions(uri)
+        if host is None:
+            return
+
+        if host not in self._hosts:
+            if len(self._hosts) >= MAX_HOSTS:
+                self._remove_host(min(self._hosts,
+                                      key=lambda h: self._hosts[h][0]))
+            self._hosts[host] = [0, set()]
+
+        host_info = self._hosts[host]
+        host_info[0] += visits
+        for key in keys:
+            if key not in host_info[1]:
+                if len(host_info[1]) >= MAX_KEYS_PER_HOST:
+                    continue
+                host_info[1].add(key)
+                self._key_hosts[key] = self._key_hosts.get(key, 0) + 1
+            self._insert(key, frecency)
+
+    def complete(self, text):
+        """Return the text to append to text to complete it to the
+        best known host or path, or None."""
+        prefix = strip_uri(text)
+        if not prefix:
+            return None
+
+        node = self._root
+        i = 0
+        while i < len(prefix):
+            children = node[_CHILDREN]
+            child = children and children.get(prefix[i])
+            if child is None:
+                return None
+            label = child[_LABEL]
+            if label.startswith(prefix[i:]):
+                node = child
+                break
+            if not prefix.startswith(label, i):
+                return None
+            node = child
+            i += len(label)
+
+        best = node[_BEST]
+        if best is None or len(best) == len(prefix):
+            return None
+        return best[len(prefix):]
+
+    def __len__(self):
+        return len(self._key_hosts)
+
+    def _insert(self, key, frecency):
+        node = self._root
+        path = [node]
+        i = 0
+        while i < len(key):
+            children = node[_CHILDREN]
+            if children is None:
+                children = node[_CHILDREN] = {}
+            child = children.get(key[i])
+            if child is None:
+                child = children[key[i]] = _new_node(key[i:])
+                path.append(child)
+                node = child
+                break
+
+            label = child[_LABEL]
+            common = 0
+            while common < len(label) and i + common < len(key) and \
+                    label[common] == key[i + common]:
+                common += 1
+
+            if common < len(label):
+                # Split the edge, the new node takes the first part.
+                middle = _new_node(label[:common])
+                middle[_CHILDREN] = {label[common]: child}
+                middle[_BEST_WEIGHT] = child[_BEST_WEIGHT]
+                middle[_BEST] = child[_BEST]
+                child[_LABEL] = label[common:]
+                children[key[i]] = middle
+                child = middle
+
+            path.append(child)
+            node = child
+            i += common
+
+        weight = places.frecency_add(node[_WEIGHT], frecency)
+        node[_WEIGHT] = weight
+
+        # Weights only grow, so the best completion of every node in
+        # the path is either unchanged or this one.
+        for node in path:
+            if node[_BEST] == key or node[_BEST_WEIGHT] is None or \
+                    weight > node[_BEST_WEIGHT]:
+                node[_BEST_WEIGHT] = weight
+                node[_BEST] = key
+
+    def _remove_host(self, host):
+        for key in self._hosts.pop(host)[1]:
+            self._key_hosts[key] -= 1
+            if not self._key_hosts[key]:
+                del self._key_hosts[key]
+                self._remove(key)
+
+    def _remove(self, key):
+        node = self._root
+        path = [(node, '')]
+        i = 0
+        while i < len(key):
+            node = node[_CHILDREN][key[i]]
+            i += len(node[_LABEL])
+            path.append((node, key[:i]))
+
+        node[_WEIGHT] = None
+
+        # Drop the nodes left without any completion.
+        while len(path) > 1:
+            node = path[-1][0]
+            if node[_WEIGHT] is not None or node[_CHILDREN]:
+                break
+            parent = path[-2][0]
+            del parent[_CHILDREN][node[_LABEL][0]]
+            if not parent[_CHILDREN]:
+                parent[_CHILDREN] = None
+            path.pop()
+
+        # Recompute the best completions bottom up.
+        for node, node_key in reversed(path):
+            if node[_WEIGHT] is None:
+                best_weight, best = None, None
+            else:
+                best_weight, best = node[_WEIGHT], node_key
+            for child in (node[_CHILDREN] or {}).values():
+                if best_weight is None or child[_BEST_WEIGHT] > best_weight:
+                    best_weight, best = child[_BEST_WEIGHT], child[_BEST]
+            node[_BEST_WEIGHT] = best_weight
+            node[_BEST] = best
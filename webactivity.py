@@ -59,6 +59,20 @@ _profile_version = 0
 _profile_path = os.path.join(activity.get_activity_root(), 'data/gecko')
 _version_file = os.path.join(_profile_path, 'version')
 _cookies_db_path = os.path.join(_profile_path, 'cookies.sqlite')
+_thumbnails_path = os.path.join(activity.get_activity_root(),
+                                'data/thumbnails')
+# Seconds the thumbnails of other Journal entries are kept in
+# _thumbnails_path, the entries carry them.
+_THUMBNAILS_MAX_AGE = 24 * 60 * 60
+
+# Where the history is kept, 'sqlite' (the default) or 'memory' for
+# sessions that don't keep it, and the file the in-memory history is
+# written to when the activity is kept in the Journal, if any.
+HISTORY_BACKEND_GCONF_KEY = '/desktop/sugar/browser/history_backend'
+HISTORY_SNAPSHOT_GCONF_KEY = '/desktop/sugar/browser/history_snapshot'
+# Format of the Journal entries, 'json' (the default) or 'binary' for
+# the format of sessionfile, where the tabs are read before the links.
+SESSION_FORMAT_GCONF_KEY = '/desktop/sugar/browser/session_format'
 
 if os.path.exists(_version_file):
     f = open(_version_file)
@@ -118,6 +132,22 @@ def _seed_xs_cookie(cookie_jar):
     _logger.debug('seed_xs_cookie: Updated cookie successfully')
 
 
+def _set_places_backend():
+    client = GConf.Client.get_default()
+    backend = client.get_string(HISTORY_BACKEND_GCONF_KEY)
+    if not backend:
+        return
+
+    if backend == 'memory':
+        args = (client.get_string(HISTORY_SNAPSHOT_GCONF_KEY) or None,)
+    else:
+        args = ()
+    try:
+        places.set_backend(backend, *args)
+    except ValueError, e:
+        _logger.error('set_places_backend: %s', e)
+
+
 from browser import TabbedView
 from browser import ZOOM_ORIGINAL
 from webtoolbar import PrimaryToolbar
@@ -128,9 +158,13 @@ import downloadmanager
 # TODO: make the registration clearer SL #3087
 
 from model import Model
+from model import link_hash
+from thumbnailstore import ThumbnailStore
 from sugar3.presence.tubeconn import TubeConnection
 from messenger import Messenger
 from linkbutton import LinkButton
+import globalhistory
+import places
 
 SERVICE = "org.laptop.WebActivity"
 IFACE = SERVICE
@@ -158,6 +192,7 @@ class WebActivity(activity.Activity):
         session.add_feature(cookie_jar)
 
         _seed_xs_cookie(cookie_jar)
+        _set_places_backend()
 
         # FIXME
         # downloadmanager.remove_old_parts()
@@ -201,7 +236,7 @@ class WebActivity(activity.Activity):
         self.set_canvas(self._tabbed_view)
         self._tabbed_view.show()
 
-        self.model = Model()
+        self.model = Model(ThumbnailStore(_thumbnails_path))
         self.model.connect('add_link', self._add_link_model_cb)
 
         self.connect('key-press-event', self._key_press_cb)
@@ -381,7 +416,7 @@ class WebActivity(activity.Activity):
                                        self.model)
 
     def _get_data_from_file_path(self, file_path):
-        fd = open(file_path, 'r')
+        fd = open(file_path, 'rb')
         try:
             data = fd.read()
         finally:
@@ -392,16 +427,7 @@ class WebActivity(activity.Activity):
         if self.metadata['mime_type'] == 'text/plain':
             data = self._get_data_from_file_path(file_path)
             self.model.deserialize(data)
-
-            for link in self.model.data['shared_links']:
-                _logger.debug('read: url=%s title=%s d=%s' % (link['url'],
-                                                              link['title'],
-                                                              link['color']))
-                self._add_link_totray(link['url'],
-                                      base64.b64decode(link['thumb']),
-                                      link['color'], link['title'],
-                                      link['owner'], -1, link['hash'])
-            logging.debug('########## reading %s', data)
+            logging.debug('########## read %d bytes', len(data))
             self._tabbed_view.set_history(self.model.data['history'])
             for number, tab in enumerate(self.model.data['currents']):
                 tab_page = self._tabbed_view.get_nth_page(number)
@@ -412,6 +438,9 @@ class WebActivity(activity.Activity):
                 tab_page.browser.grab_focus()
 
             self._tabbed_view.set_current_page(self.model.data['current_tab'])
+            # The links of binary entries are decoded once the tabs
+            # are shown.
+            GObject.idle_add(self.__load_links_cb)
 
         elif self.metadata['mime_type'] == 'text/uri-list':
             data = self._get_data_from_file_path(file_path)
@@ -426,7 +455,28 @@ class WebActivity(activity.Activity):
             self._tabbed_view.props.current_browser.load_uri(file_uri)
             self._tabbed_view.props.current_browser.grab_focus()
 
+    def __load_links_cb(self):
+        self.model.load_links()
+        for link in self.model.data['shared_links']:
+            _logger.debug('read: url=%s title=%s d=%s' % (link['url'],
+                                                          link['title'],
+                                                          link['color']))
+            self._add_link_totray(link, -1)
+        return False
+
+    def copy(self):
+        # Keeping the activity in the Journal is the explicit save of
+        # the user, the only time an in-memory history is written to
+        # disk.
+        places.get_store().save()
+        activity.Activity.copy(self)
+
     def write_file(self, file_path):
+        # Saving is also our chance to write the history updates
+        # that are still queued, and maintain the database, before
+        # the activity is closed.
+        globalhistory.get_global_history().maintain()
+
         if not self.metadata['mime_type']:
             self.metadata['mime_type'] = 'text/plain'
 
@@ -457,13 +507,23 @@ class WebActivity(activity.Activity):
 
                     self.model.data['currents'].append(info)
 
-            f = open(file_path, 'w')
+            client = GConf.Client.get_default()
+            if client.get_string(SESSION_FORMAT_GCONF_KEY) == 'binary':
+                data = self.model.serialize_session()
+            else:
+                data = self.model.serialize()
+            f = open(file_path, 'wb')
             try:
-                logging.debug('########## writing %s', self.model.serialize())
-                f.write(self.model.serialize())
+                logging.debug('########## writing %d bytes', len(data))
+                f.write(data)
             finally:
                 f.close()
 
+            removed = self.model.thumbnails.sweep(
+                self.model.thumbnail_keys(), _THUMBNAILS_MAX_AGE)
+            if removed:
+                logging.debug('Removed %d unused thumbnails', removed)
+
     def _link_add_button_cb(self, button):
         self._add_link()
 
@@ -568,11 +628,9 @@ class WebActivity(activity.Activity):
         browser = self._tabbed_view.props.current_browser
         ui_uri = browser.get_uri()
 
-        for link in self.model.data['shared_links']:
-            if link['hash'] == sha1(ui_uri).hexdigest():
-                _logger.debug('_add_link: link exist already a=%s b=%s',
-                              link['hash'], sha1(ui_uri).hexdigest())
-                return
+        if self.model.get_link(link_hash(ui_uri)) is not None:
+            _logger.debug('_add_link: link exist already %s', ui_uri)
+            return
         buf = self._get_screenshot()
         timestamp = time.time()
         self.model.add_link(ui_uri, browser.props.title, buf,
@@ -588,14 +646,14 @@ class WebActivity(activity.Activity):
     def _add_link_model_cb(self, model, index):
         ''' receive index of new link from the model '''
         link = self.model.data['shared_links'][index]
-        self._add_link_totray(link['url'], base64.b64decode(link['thumb']),
-                              link['color'], link['title'],
-                              link['owner'], index, link['hash'])
-
-    def _add_link_totray(self, url, buf, color, title, owner, index, hash):
-        ''' add a link to the tray '''
-        item = LinkButton(buf, color, title, owner, hash)
-        item.connect('clicked', self._link_clicked_cb, url)
+        self._add_link_totray(link, index)
+
+    def _add_link_totray(self, link, index):
+        ''' add a link to the tray, its thumbnail is read when shown '''
+        item = LinkButton(lambda: self.model.get_thumbnail(link),
+                          link['color'], link['title'], link['owner'],
+                          link['hash'])
+        item.connect('clicked', self._link_clicked_cb, link['url'])
         item.connect('remove_link', self._link_removed_cb)
         # use index to add to the tray
         self._tray.add_item(item, index)
@@ -41,7 +41,8 @@ from sugar3.graphics.icon import Icon
 
 import tempfile
 import filepicker
-import places
+import globalhistory
+from suggestions import SuggestionWorker
 from browser import Browser
 from browser import HOME_PAGE_GCONF_KEY, LIBRARY_PATH
 
@@ -68,7 +69,11 @@ class WebEntry(iconentry.IconEntry):
         GObject.GObject.__init__(self)
 
         self._address = None
+        # The text typed by the user, without the inline completion.
+        self._typed_text = u''
+        self._search_store = Gtk.ListStore(str, str)
         self._search_view = self._search_create_view()
+        self._suggestions = SuggestionWorker(self.__suggestions_cb)
 
         self._search_window = _SearchWindow()
         self._search_window.add(self._search_view)
@@ -125,11 +130,12 @@ class WebEntry(iconentry.IconEntry):
         self._address = address
         if address is not None:
             self._set_text(address)
+            self._typed_text = address.decode('utf-8')
 
     address = GObject.property(type=str, setter=_set_address)
 
     def _search_create_view(self):
-        view = Gtk.TreeView()
+        view = Gtk.TreeView(model=self._search_store)
         view.props.headers_visible = False
 
         view.connect('button-press-event', self.__view_button_press_event_cb)
@@ -159,16 +165,35 @@ class WebEntry(iconentry.IconEntry):
 
         return view
 
-    def _search_update(self):
-        list_store = Gtk.ListStore(str, str)
-
-        search_text = self.props.text.decode('utf-8')
-        for place in places.get_store().search(search_text):
-            list_store.append([place.uri, place.title])
-
-        self._search_view.set_model(list_store)
-
-        return len(list_store) > 0
+    def _search_update(self, search_text):
+        self._suggestions.query(search_text)
+
+    def _complete_inline(self, text):
+        """Append the most likely completion of text, selected so that
+        typing replaces it.  Nothing is completed when the user is
+        deleting text."""
+        typed_text, self._typed_text = self._typed_text, text
+        if len(text) <= len(typed_text) or not text.startswith(typed_text):
+            return
+
+        completion = globalhistory.get_global_history().complete(text)
+        if completion:
+            self._set_text(text + completion)
+            self.select_region(len(text), -1)
+
+    def __suggestions_cb(self, search_text, result):
+        # Detach the store while filling it, so the view isn't
+        # updated once per row.
+        self._search_view.set_model(None)
+        self._search_store.clear()
+        for place in result:
+            self._search_store.append([place.uri, place.title])
+        self._search_view.set_model(self._search_store)
+
+        if len(self._search_store) > 0:
+            self._search_popup()
+        else:
+            self._search_popdown()
 
     def _search_popup(self):
         miss, window_x, window_y = self.props.window.get_origin()
@@ -187,6 +212,8 @@ class WebEntry(iconentry.IconEntry):
         self._search_window.show()
 
     def _search_popdown(self):
+        # Results of queries still running are not wanted anymore.
+        self._suggestions.cancel()
         self._search_window.hide()
 
     def __focus_in_event_cb(self, entry, event):
@@ -248,12 +275,14 @@ class WebEntry(iconentry.IconEntry):
         menu.connect('unmap', self.__popup_unmap_cb)
 
     def __changed_cb(self, entry):
+        text = self.props.text.decode('utf-8')
+        self._complete_inline(text)
         self._address = self.props.text
 
-        if not self.props.text or not self._search_update():
+        if not text:
             self._search_popdown()
         else:
-            self._search_popup()
+            self._search_update(text)
 
 
 class UrlToolbar(Gtk.EventBox):
@@ -595,6 +624,7 @@ class PrimaryToolbar(ToolbarBase):
     def _entry_activate_cb(self, entry):
         url = entry.props.text
         effective_url = self._tabbed_view.normalize_or_autosearch_url(url)
+        globalhistory.get_global_history().set_typed_uri(effective_url)
         self._browser.load_uri(effective_url)
         self._browser.loading_uri = effective_url
         self.entry.props.address = effective_url